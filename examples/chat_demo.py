@@ -29,10 +29,13 @@ def main():
         conversation.append({"role": "user", "content": user_input})
         
         # Get response from the memory system
-        result = memory_system.chat_with_memory(conversation)
+        result = memory_system.chat_with_memory(conversation, stream=True)
         
-        # Print the response
-        print(f"Assistant: {result['response']}")
+        # Print the response as it arrives
+        print("Assistant: ", end="", flush=True)
+        for token in result['response_stream']:
+            print(token, end="", flush=True)
+        print()
         
         # Add assistant response to conversation
         conversation.append({"role": "assistant", "content": result['response']})
@@ -1,6 +1,24 @@
+import re
 from typing import List, Dict, Any, Optional
 from .openai_client import OpenAIClient
 
+# Cheap first-pass filters: when the latest user message matches neither,
+# there is nothing to remember or forget and the LLM calls are skipped
+_MEMORY_SIGNAL = re.compile(
+    r"\b(i|we)\s+(?:really\s+|also\s+|usually\s+|still\s+)?"
+    r"(use|like|love|enjoy|hate|dislike|prefer|am|live|work|have|own|study|play|want|need)\b"
+    r"|\b(i'?m|i've|i'd)\b|\bmy\s+\w+|\bremember\b",
+    re.I
+)
+_DELETION_SIGNAL = re.compile(
+    r"\b(don'?t|doesn'?t|no longer|stopped|quit|not any ?more|anymore|"
+    r"remove|forget|delete|moved|switched|changed)\b",
+    re.I
+)
+
+# Phone keyboards type curly apostrophes, which the filters above don't match
+_APOSTROPHES = str.maketrans({'\u2019': "'", '\u2018': "'", '\u02bc': "'"})
+
 class MemoryExtractor:
     """Extracts relevant memories from conversations."""
     
@@ -8,6 +26,37 @@ class MemoryExtractor:
         """Initialize with an OpenAI client."""
         self.openai_client = openai_client
     
+    def _last_user_message(self, conversation: List[Dict[str, str]]) -> str:
+        """Return the content of the last user message with plain apostrophes, or an empty string."""
+        for message in reversed(conversation):
+            if message['role'] == 'user':
+                return message['content'].translate(_APOSTROPHES)
+        return ""
+    
+    def has_memory_signal(self, conversation: List[Dict[str, str]]) -> bool:
+        """
+        Check whether the latest user message may contain something worth remembering.
+        
+        Args:
+            conversation: A list of message dictionaries with 'role' and 'content' keys.
+            
+        Returns:
+            True if the message looks like a personal statement, False otherwise.
+        """
+        return bool(_MEMORY_SIGNAL.search(self._last_user_message(conversation)))
+    
+    def has_deletion_signal(self, conversation: List[Dict[str, str]]) -> bool:
+        """
+        Check whether the latest user message may invalidate stored memories.
+        
+        Args:
+            conversation: A list of message dictionaries with 'role' and 'content' keys.
+            
+        Returns:
+            True if the message looks like a retraction or change, False otherwise.
+        """
+        return bool(_DELETION_SIGNAL.search(self._last_user_message(conversation)))
+    
     def extract_memories(self, conversation: List[Dict[str, str]], 
                         importance_threshold: int = 5) -> List[Dict[str, Any]]:
         """
@@ -20,6 +69,10 @@ class MemoryExtractor:
         Returns:
             A list of memory dictionaries that meet the importance threshold.
         """
+        # Skip the OpenAI call when there is nothing worth remembering
+        if not self.has_memory_signal(conversation):
+            return []
+        
         # Get potential memories from OpenAI
         potential_memories = self.openai_client.extract_memories(conversation)
         
@@ -31,6 +84,28 @@ class MemoryExtractor:
         
         return memories
     
+    async def aextract_memories(self, conversation: List[Dict[str, str]], 
+                                importance_threshold: int = 5) -> List[Dict[str, Any]]:
+        """
+        Asynchronous version of extract_memories.
+        
+        Args:
+            conversation: A list of message dictionaries with 'role' and 'content' keys.
+            importance_threshold: Minimum importance score for a memory to be stored.
+            
+        Returns:
+            A list of memory dictionaries that meet the importance threshold.
+        """
+        if not self.has_memory_signal(conversation):
+            return []
+        
+        potential_memories = await self.openai_client.aextract_memories(conversation)
+        
+        return [
+            memory for memory in potential_memories 
+            if memory.get('importance', 0) >= importance_threshold
+        ]
+    
     def should_store_memory(self, memory: Dict[str, Any], threshold: int = 5) -> bool:
         """
         Determine if a memory should be stored based on its importance.
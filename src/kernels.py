@@ -0,0 +1,218 @@
+import os
+import functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+# Matrices with at least this many rows are scored in parallel row blocks
+PARALLEL_SCORE_ROWS = 65536
+
+# Rows of an int8 matrix upcast at a time by the NumPy int8 kernel
+INT8_SCORE_BLOCK_ROWS = 256
+
+@functools.lru_cache(maxsize=None)
+def _score_pool() -> ThreadPoolExecutor:
+    """Return the shared thread pool used to score row blocks."""
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
+def _score_row_blocks(rows: int, score_block: Callable[[int, int], Any]) -> None:
+    """
+    Call score_block(start, stop) over all rows, in one row block per core for large matrices.
+    
+    NumPy releases the GIL while casting and inside matmul, so the blocks are
+    scored concurrently; each writes its slice of a shared result in place.
+    """
+    workers = os.cpu_count() or 1
+    if rows < PARALLEL_SCORE_ROWS or workers == 1:
+        score_block(0, rows)
+        return
+    
+    bounds = np.linspace(0, rows, workers + 1).astype(np.int64)
+    blocks = _score_pool().map(score_block, bounds[:-1], bounds[1:])
+    # Consume the results so errors in any block are raised here
+    for _ in blocks:
+        pass
+
+def _blocked_matmul(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Compute matrix @ query, splitting large matrices into one row block per core."""
+    out = np.empty(len(matrix), dtype=np.result_type(matrix, query))
+    _score_row_blocks(
+        len(matrix), lambda start, stop: np.matmul(matrix[start:stop], query, out=out[start:stop])
+    )
+    return out
+
+def _normalize_numpy(vector: np.ndarray) -> np.ndarray:
+    """Return a float32 copy of a 1-D vector scaled to unit length."""
+    vector = np.array(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+def _normalize_rows_numpy(matrix: np.ndarray) -> np.ndarray:
+    """Return a float32 copy of a 2-D matrix with every row scaled to unit length."""
+    matrix = np.array(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+def _dot_scores_numpy(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Score every row of a matrix against a query with BLAS matrix-vector products."""
+    return _blocked_matmul(matrix, query)
+
+def _int8_matmul_into(matrix: np.ndarray, query: np.ndarray, out: np.ndarray) -> None:
+    """Write the dots of int8 rows with a float32 query into out, upcasting a block of rows at a time."""
+    block = np.empty((min(INT8_SCORE_BLOCK_ROWS, len(matrix)), matrix.shape[1]), dtype=np.float32)
+    for start in range(0, len(matrix), INT8_SCORE_BLOCK_ROWS):
+        stop = min(start + INT8_SCORE_BLOCK_ROWS, len(matrix))
+        rows = block[:stop - start]
+        rows[...] = matrix[start:stop]
+        np.matmul(rows, query, out=out[start:stop])
+
+def _int8_dot_scores_numpy(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """
+    Dot every int8 row of a matrix with an int8 query.
+    
+    NumPy has no int8 matrix-vector kernel and would cast the whole matrix to
+    the query's dtype, so rows are upcast one block at a time into a reused
+    float32 buffer and scored with BLAS; large matrices are split into one
+    row range per core, each with its own buffer. Float32 sums are exact
+    below 2**24 and off by at most a relative 6e-8 above it.
+    """
+    out = np.empty(len(matrix), dtype=np.float32)
+    query = query.astype(np.float32)
+    _score_row_blocks(
+        len(matrix),
+        lambda start, stop: _int8_matmul_into(matrix[start:stop], query, out[start:stop])
+    )
+    return out
+
+# Set bits in every byte value, for NumPy versions without bitwise_count
+_BYTE_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+def _hamming_distances_numpy(signatures: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Count the differing bits between each uint64 signature and a query signature."""
+    differing = np.bitwise_xor(signatures, query)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(differing)
+    return _BYTE_POPCOUNT[differing.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+if njit is not None:
+    # 1-D and 2-D inputs get separate kernels so Numba types each one once.
+    # Accumulators are float32 so the inner loops vectorize at full float32
+    # SIMD width instead of widening every product to float64.
+    @njit(fastmath=True, cache=True)
+    def _normalize_numba(vector):
+        out = vector.astype(np.float32)
+        norm = np.float32(0.0)
+        for d in range(out.shape[0]):
+            norm += out[d] * out[d]
+        if norm > 0:
+            scale = np.float32(1.0) / np.sqrt(norm)
+            for d in range(out.shape[0]):
+                out[d] *= scale
+        return out
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _normalize_rows_numba(matrix):
+        out = matrix.astype(np.float32)
+        for i in prange(out.shape[0]):
+            norm = np.float32(0.0)
+            for d in range(out.shape[1]):
+                norm += out[i, d] * out[i, d]
+            if norm > 0:
+                scale = np.float32(1.0) / np.sqrt(norm)
+                for d in range(out.shape[1]):
+                    out[i, d] *= scale
+        return out
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _dot_scores_numba(matrix, query):
+        out = np.empty(matrix.shape[0], np.float32)
+        for i in prange(matrix.shape[0]):
+            acc = np.float32(0.0)
+            for d in range(matrix.shape[1]):
+                acc += matrix[i, d] * query[d]
+            out[i] = acc
+        return out
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _int8_dot_scores_numba(matrix, query):
+        out = np.empty(matrix.shape[0], np.int32)
+        for i in prange(matrix.shape[0]):
+            acc = 0
+            for d in range(matrix.shape[1]):
+                acc += np.int32(matrix[i, d]) * np.int32(query[d])
+            out[i] = acc
+        return out
+
+    @njit(parallel=True, cache=True)
+    def _hamming_distances_numba(signatures, query):
+        out = np.empty(signatures.shape[0], np.uint8)
+        for i in prange(signatures.shape[0]):
+            # SWAR popcount: sum bits in 2-, 4- and 8-bit lanes, then add the bytes
+            x = signatures[i] ^ query
+            x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+            x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+            x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+            out[i] = (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+        return out
+
+    normalize = _normalize_numba
+    normalize_rows = _normalize_rows_numba
+    dot_scores = _dot_scores_numba
+    int8_dot_scores = _int8_dot_scores_numba
+    hamming_distances = _hamming_distances_numba
+else:
+    normalize = _normalize_numpy
+    normalize_rows = _normalize_rows_numpy
+    dot_scores = _dot_scores_numpy
+    int8_dot_scores = _int8_dot_scores_numpy
+    hamming_distances = _hamming_distances_numpy
+
+def cosine_scores(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """
+    Score every row of a unit-length float32 matrix against a unit-length query.
+    
+    Uses SimSIMD's runtime-dispatched SIMD kernels when installed, and
+    dot_scores otherwise (for unit-length vectors the two agree).
+    """
+    if simsimd is not None and len(matrix):
+        distances = simsimd.cdist(query[None, :], matrix, metric="cosine")
+        return 1.0 - np.asarray(distances, dtype=np.float32).ravel()
+    return dot_scores(matrix, query)
+
+def lsh_signatures(matrix: np.ndarray, projection: np.ndarray) -> np.ndarray:
+    """
+    Compute a random-hyperplane signature for every row of a matrix.
+    
+    Bit j of a row's signature is set when the row lies on the positive side
+    of hyperplane j, so the Hamming distance between two signatures grows
+    with the angle between the rows.
+    
+    Args:
+        matrix: A (N, D) matrix of embeddings.
+        projection: A (D, 64) matrix whose columns are the hyperplane normals.
+        
+    Returns:
+        The N signatures as uint64.
+    """
+    bits = (matrix @ projection) > 0
+    return np.packbits(bits, axis=1).view(np.uint64).ravel()
+
+def warm_up() -> None:
+    """Compile the kernels ahead of time so the first query doesn't pay JIT latency."""
+    vector = np.ones(2, dtype=np.float32)
+    matrix = np.ones((2, 2), dtype=np.float32)
+    dot_scores(normalize_rows(matrix), normalize(vector))
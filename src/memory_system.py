@@ -1,22 +1,36 @@
 import os
+import asyncio
+import logging
 import numpy as np
-from typing import List, Dict, Any, Optional
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 
-from .storage import MemoryStorage
+from .storage import MemoryStorage, content_hash
 from .extractor import MemoryExtractor
 from .retriever import MemoryRetriever
 from .openai_client import OpenAIClient
+from .kernels import normalize, normalize_rows, warm_up
+
+logger = logging.getLogger(__name__)
 
 class MemorySystem:
     """Main class that ties all memory components together."""
     
-    def __init__(self, api_key: Optional[str] = None, db_path: str = "memories.db"):
+    def __init__(self, api_key: Optional[str] = None, db_path: str = "memories.db", 
+                 quantize_embeddings: bool = False, embedding_dtype: Any = None):
         """
         Initialize the memory system.
         
         Args:
             api_key: OpenAI API key. If not provided, will try to get from environment variable.
             db_path: Path to the SQLite database file.
+            quantize_embeddings: Whether the FAISS index (if installed) keeps embeddings
+                as 8-bit scalars instead of float32.
+            embedding_dtype: NumPy dtype embeddings are stored in. It must match
+                the dtype of an existing database; databases written before the
+                dtype was recorded hold float32. None uses the database's dtype,
+                or float16 for a new database.
         """
         # Get API key from parameter or environment variable
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
@@ -24,10 +38,198 @@ class MemorySystem:
             raise ValueError("OpenAI API key is required. Set it as a parameter or OPENAI_API_KEY environment variable.")
         
         # Initialize components
-        self.storage = MemoryStorage(db_path)
+        self.storage = MemoryStorage(
+            db_path, embedding_dtype=embedding_dtype, new_embedding_dtype=np.float16
+        )
         self.openai_client = OpenAIClient(self.api_key)
         self.extractor = MemoryExtractor(self.openai_client)
-        self.retriever = MemoryRetriever(self.openai_client)
+        self.retriever = MemoryRetriever(
+            self.openai_client, index_path=f"{db_path}.faiss", quantize=quantize_embeddings
+        )
+        
+        # Searches score the storage's in-memory embedding copy, which every
+        # write keeps current. The FAISS index follows writes made here and is
+        # rebuilt once the copy's generation shows writes made elsewhere.
+        self.storage.get_embedding_matrix()
+        self.retriever.index_generation = self.storage.embedding_generation
+        warm_up()
+    
+    def _embedding_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the current embedding matrix and row IDs, dropping a FAISS index that fell behind."""
+        matrix, row_to_id = self.storage.get_embedding_matrix()
+        if self.storage.embedding_generation != self.retriever.index_generation:
+            self.retriever.invalidate_index()
+            self.retriever.index_generation = self.storage.embedding_generation
+        return matrix, row_to_id
+    
+    @contextmanager
+    def _tracking_index(self) -> Iterator[None]:
+        """Keep the FAISS index marked current across a write it is updated for."""
+        generation = self.storage.embedding_generation
+        yield
+        if self.retriever.index_generation == generation:
+            self.retriever.index_generation = self.storage.embedding_generation
+    
+    def _search(self, query: str, limit: int = 5) -> List[Dict[str, Any]]:
+        """Find the top memories for a query and load only those from storage."""
+        matrix, row_to_id = self._embedding_matrix()
+        scored = self.retriever.retrieve_relevant_memories(query, matrix, row_to_id, limit)
+        
+        similarities = dict(scored)
+        memories = self.storage.get_memories_by_ids([memory_id for memory_id, _ in scored])
+        for memory in memories:
+            memory['similarity'] = similarities[memory['id']]
+        
+        return memories
+    
+    def _add_unique(self, contents: List[str], 
+                    metadatas: List[Optional[Dict[str, Any]]]) -> Tuple[List[int], List[bool]]:
+        """
+        Embed and store the contents that aren't stored yet.
+        
+        Duplicates, whether already stored or repeated within the batch, are
+        detected by content hash before any embedding request is made.
+        
+        Args:
+            contents: The contents of the memories.
+            metadatas: The metadata for each memory, or None.
+            
+        Returns:
+            The memory ID for each content, and whether it was newly stored.
+        """
+        memory_ids = self.storage.get_ids_by_content(contents)
+        digests = [content_hash(content) for content in contents]
+        
+        # Keep the first occurrence of each content that isn't stored yet
+        first_index = {}
+        for i, (digest, memory_id) in enumerate(zip(digests, memory_ids)):
+            if memory_id is None:
+                first_index.setdefault(digest, i)
+        new_indices = list(first_index.values())
+        
+        if new_indices:
+            # Embed all new memories with a single request and normalize before storing
+            embeddings = normalize_rows(np.asarray(
+                self.openai_client.get_embeddings([contents[i] for i in new_indices]),
+                dtype=np.float32
+            ))
+            
+            # Store all new memories in a single transaction
+            with self._tracking_index():
+                new_ids = self.storage.add_memories_array(
+                    [contents[i] for i in new_indices], embeddings, [metadatas[i] for i in new_indices]
+                )
+                for memory_id, embedding in zip(new_ids, embeddings):
+                    self.retriever.add_to_index(memory_id, embedding)
+            
+            # Repeats within the batch share the ID of their first occurrence
+            new_ids_by_digest = dict(zip(first_index, new_ids))
+            for i, digest in enumerate(digests):
+                if memory_ids[i] is None:
+                    memory_ids[i] = new_ids_by_digest[digest]
+        
+        is_new = [False] * len(contents)
+        for i in new_indices:
+            is_new[i] = True
+        
+        return memory_ids, is_new
+    
+    def _store_memories(self, memories: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Embed and store extracted memories, skipping ones already stored.
+        
+        Args:
+            memories: Memory dictionaries as returned by the extractor.
+            
+        Returns:
+            The newly stored memories, each with its new 'id'.
+        """
+        if not memories:
+            return []
+        
+        metadatas = [
+            {
+                'importance': memory.get('importance', 5),
+                'category': memory.get('category', 'general'),
+                'entities': memory.get('entities', [])
+            }
+            for memory in memories
+        ]
+        
+        memory_ids, is_new = self._add_unique([memory['content'] for memory in memories], metadatas)
+        
+        return [
+            {
+                'id': memory_id,
+                'content': memory['content'],
+                'metadata': metadata
+            }
+            for memory_id, memory, metadata, new in zip(memory_ids, memories, metadatas, is_new)
+            if new
+        ]
+    
+    def _delete_memories(self, memory_ids: List[Any]) -> List[int]:
+        """Delete the given memories and return the IDs that were actually deleted."""
+        # IDs come from model output, which may give them as strings
+        valid_ids = []
+        for memory_id in memory_ids or []:
+            try:
+                valid_ids.append(int(memory_id))
+            except (TypeError, ValueError):
+                continue
+        return [memory_id for memory_id in valid_ids if self.delete_memory(memory_id)]
+    
+    def _apply_analysis(self, analysis: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
+        """Store the new memories and delete the obsolete ones found by analyze_turn."""
+        new_memories = [
+            memory for memory in analysis['new_memories']
+            if self.extractor.should_store_memory(memory)
+        ]
+        
+        return {
+            'new_memories': self._store_memories(new_memories),
+            'deleted_memories': self._delete_memories(analysis['delete_ids'])
+        }
+    
+    def _analysis_result(self, analysis_future: Future) -> Dict[str, List[Any]]:
+        """Wait for a turn's analysis; a failure is logged and leaves the memories unchanged."""
+        try:
+            return analysis_future.result()
+        except Exception:
+            # The reply is still returned when the background analysis fails
+            logger.exception("Turn analysis failed; no memories were added or deleted")
+            return {'new_memories': [], 'delete_ids': []}
+    
+    def _stream_response(self, token_stream: Iterator[str], analysis_future: Future, 
+                         result: Dict[str, Any]) -> Iterator[str]:
+        """
+        Yield response tokens, then fill in the result once the stream is exhausted.
+        
+        Args:
+            token_stream: The streamed chat completion.
+            analysis_future: The pending analyze_turn call for this turn.
+            result: The dictionary returned by chat_with_memory, updated in place.
+            
+        Yields:
+            Pieces of the generated response text, in order.
+        """
+        chunks = []
+        for token in token_stream:
+            chunks.append(token)
+            yield token
+        
+        result['response'] = "".join(chunks)
+        
+        applied = self._apply_analysis(self._analysis_result(analysis_future))
+        result['new_memories'].extend(applied['new_memories'])
+        result['deleted_memories'].extend(applied['deleted_memories'])
+    
+    def _last_user_message(self, conversation: List[Dict[str, str]]) -> Optional[str]:
+        """Return the content of the last user message in a conversation, if any."""
+        for message in reversed(conversation):
+            if message['role'] == 'user':
+                return message['content']
+        return None
     
     def process_conversation(self, conversation: List[Dict[str, str]], 
                            extract_memories: bool = True, 
@@ -52,58 +254,85 @@ class MemorySystem:
         # Extract new memories if requested
         if extract_memories:
             memories = self.extractor.extract_memories(conversation)
-            
-            for memory in memories:
-                # Get embedding for the memory content
-                embedding = self.openai_client.get_embedding(memory['content'])
-                
-                # Store the memory
-                memory_id = self.storage.add_memory(
-                    content=memory['content'],
-                    embedding=embedding,
-                    metadata={
-                        'importance': memory.get('importance', 5),
-                        'category': memory.get('category', 'general'),
-                        'entities': memory.get('entities', [])
-                    }
-                )
-                
-                result['new_memories'].append({
-                    'id': memory_id,
-                    'content': memory['content'],
-                    'metadata': {
-                        'importance': memory.get('importance', 5),
-                        'category': memory.get('category', 'general'),
-                        'entities': memory.get('entities', [])
-                    }
-                })
-        
-        # Check for memories to delete if requested
-        if check_for_deletions:
-            all_memories = self.storage.get_all_memories()
+            result['new_memories'] = self._store_memories(memories)
+        
+        # Check for memories to delete if requested and the user hinted at a change
+        if check_for_deletions and self.extractor.has_deletion_signal(conversation):
+            # The prompt only needs IDs and contents, so skip the embedding blobs
             memory_ids_to_delete = self.openai_client.identify_memories_to_delete(
-                conversation, all_memories
+                conversation, self.storage.get_all_contents()
             )
-            
-            if memory_ids_to_delete:
-                for memory_id in memory_ids_to_delete:
-                    if self.storage.delete_memory(memory_id):
-                        result['deleted_memories'].append(memory_id)
+            result['deleted_memories'] = self._delete_memories(memory_ids_to_delete)
         
         # Get relevant memories for the last user message
-        if conversation:
-            last_user_message = None
-            for message in reversed(conversation):
-                if message['role'] == 'user':
-                    last_user_message = message['content']
-                    break
+        last_user_message = self._last_user_message(conversation)
+        if last_user_message:
+            result['relevant_memories'] = self._search(last_user_message)
+        
+        return result
+    
+    async def aprocess_conversation(self, conversation: List[Dict[str, str]], 
+                                    extract_memories: bool = True, 
+                                    check_for_deletions: bool = True) -> Dict[str, Any]:
+        """
+        Asynchronous version of process_conversation.
+        
+        Extraction, deletion identification and the query embedding are
+        requested concurrently, so the OpenAI round trips overlap instead of
+        adding up. The results are then applied in the same order as
+        process_conversation.
+        
+        Args:
+            conversation: A list of message dictionaries with 'role' and 'content' keys.
+            extract_memories: Whether to extract new memories from the conversation.
+            check_for_deletions: Whether to check for memories to delete.
             
-            if last_user_message:
-                all_memories = self.storage.get_all_memories()
-                relevant_memories = self.retriever.retrieve_relevant_memories(
-                    last_user_message, all_memories
-                )
-                result['relevant_memories'] = relevant_memories
+        Returns:
+            A dictionary containing the results of the processing.
+        """
+        result = {
+            'new_memories': [],
+            'deleted_memories': [],
+            'relevant_memories': []
+        }
+        
+        async def no_results() -> List[Any]:
+            return []
+        
+        last_user_message = self._last_user_message(conversation)
+        extraction = self.extractor.aextract_memories(conversation) if extract_memories else no_results()
+        if check_for_deletions and self.extractor.has_deletion_signal(conversation):
+            deletion = self.openai_client.aidentify_memories_to_delete(
+                conversation, self.storage.get_all_contents()
+            )
+        else:
+            deletion = no_results()
+        
+        # Embedding the query up front leaves the search below a cache hit
+        query_embedding = (
+            self.openai_client.aget_embeddings([last_user_message])
+            if last_user_message else no_results()
+        )
+        
+        memories, memory_ids_to_delete, _ = await asyncio.gather(
+            extraction, deletion, query_embedding
+        )
+        
+        if memories:
+            # Embed the memories that aren't stored yet, so storing them is a cache hit
+            contents = [memory['content'] for memory in memories]
+            missing = [
+                content for content, memory_id in zip(contents, self.storage.get_ids_by_content(contents))
+                if memory_id is None
+            ]
+            if missing:
+                await self.openai_client.aget_embeddings(missing)
+            result['new_memories'] = self._store_memories(memories)
+        
+        result['deleted_memories'] = self._delete_memories(memory_ids_to_delete)
+        
+        if last_user_message:
+            result['relevant_memories'] = self._search(last_user_message)
         
         return result
     
@@ -118,8 +347,37 @@ class MemorySystem:
         Returns:
             A list of memory dictionaries, sorted by relevance.
         """
-        all_memories = self.storage.get_all_memories()
-        return self.retriever.retrieve_relevant_memories(query, all_memories, limit)
+        return self._search(query, limit)
+    
+    def get_relevant_memories_batched(self, queries: List[str], 
+                                      limit: int = 5) -> List[List[Dict[str, Any]]]:
+        """
+        Get memories relevant to each of several queries.
+        
+        Args:
+            queries: The queries to find relevant memories for.
+            limit: Maximum number of memories to return per query.
+            
+        Returns:
+            For each query, a list of memory dictionaries sorted by relevance.
+        """
+        matrix, row_to_id = self._embedding_matrix()
+        scored = self.retriever.retrieve_relevant_memories_batched(queries, matrix, row_to_id, limit)
+        
+        # Load every memory that made any top-k with one query
+        memory_ids = list(dict.fromkeys(memory_id for results in scored for memory_id, _ in results))
+        memories_by_id = {
+            memory['id']: memory for memory in self.storage.get_memories_by_ids(memory_ids)
+        }
+        
+        return [
+            [
+                dict(memories_by_id[memory_id], similarity=similarity)
+                for memory_id, similarity in results
+                if memory_id in memories_by_id
+            ]
+            for results in scored
+        ]
     
     def add_memory(self, content: str, metadata: Optional[Dict[str, Any]] = None) -> int:
         """
@@ -130,17 +388,48 @@ class MemorySystem:
             metadata: Optional metadata for the memory.
             
         Returns:
-            The ID of the newly created memory.
+            The ID of the newly created memory, or of the existing memory with
+            the same content.
         """
-        # Get embedding for the memory content
-        embedding = self.openai_client.get_embedding(content)
+        # Skip the embedding request if the content is already stored
+        memory_id = self.storage.get_ids_by_content([content])[0]
+        if memory_id is not None:
+            return memory_id
+        
+        # Get the embedding for the memory content, normalized so that
+        # similarity is a plain dot product
+        embedding = normalize(np.asarray(self.openai_client.get_embedding(content), dtype=np.float32))
         
         # Store the memory
-        return self.storage.add_memory(
-            content=content,
-            embedding=embedding,
-            metadata=metadata
+        with self._tracking_index():
+            memory_id = self.storage.add_memory(
+                content=content,
+                embedding=embedding,
+                metadata=metadata
+            )
+            self.retriever.add_to_index(memory_id, embedding)
+        
+        return memory_id
+    
+    def add_memories_bulk(self, items: List[Dict[str, Any]]) -> List[int]:
+        """
+        Add several memories with one embedding request and one database transaction.
+        
+        Args:
+            items: A list of dictionaries with a 'content' key and an optional 'metadata' key.
+            
+        Returns:
+            The IDs of the memories in input order; content that is already
+            stored maps to the existing memory.
+        """
+        if not items:
+            return []
+        
+        memory_ids, _ = self._add_unique(
+            [item['content'] for item in items],
+            [item.get('metadata') for item in items]
         )
+        return memory_ids
     
     def delete_memory(self, memory_id: int) -> bool:
         """
@@ -152,7 +441,11 @@ class MemorySystem:
         Returns:
             True if the memory was deleted, False otherwise.
         """
-        return self.storage.delete_memory(memory_id)
+        with self._tracking_index():
+            if not self.storage.delete_memory(memory_id):
+                return False
+            self.retriever.remove_from_index(memory_id)
+        return True
     
     def get_all_memories(self) -> List[Dict[str, Any]]:
         """
@@ -175,9 +468,14 @@ class MemorySystem:
         """
         return self.storage.get_memory(memory_id)
     
+    def close(self) -> None:
+        """Persist the FAISS index, if one is built, and close the underlying database connections."""
+        self.retriever.save_index()
+        self.storage.close()
+    
     def chat_with_memory(self, conversation: List[Dict[str, str]], 
                         model: str = "gpt-4", temperature: float = 0.7, 
-                        max_tokens: int = 1000) -> Dict[str, Any]:
+                        max_tokens: int = 1000, stream: bool = False) -> Dict[str, Any]:
         """
         Generate a chat response using relevant memories.
         
@@ -186,15 +484,18 @@ class MemorySystem:
             model: The OpenAI model to use.
             temperature: Controls randomness. Lower is more deterministic.
             max_tokens: Maximum number of tokens to generate.
+            stream: Whether to stream the response. If True, the result contains a
+                'response_stream' generator of text pieces; 'response', 'new_memories'
+                and 'deleted_memories' are filled in once it has been consumed.
             
         Returns:
             A dictionary containing the response and relevant memories.
         """
-        # Process the conversation to extract new memories and check for deletions
-        process_result = self.process_conversation(conversation)
-        
         # Get relevant memories for the last user message
-        relevant_memories = process_result['relevant_memories']
+        relevant_memories = []
+        last_user_message = self._last_user_message(conversation)
+        if last_user_message:
+            relevant_memories = self._search(last_user_message)
         
         # Format the memories for inclusion in the context
         memories_context = self.retriever.format_memories_for_context(relevant_memories)
@@ -208,6 +509,35 @@ class MemorySystem:
         # Create a new conversation list with the system message first
         conversation_with_memory = [system_message] + conversation
         
+        # Analyze the turn for new and obsolete memories in the background
+        # while the response is generated; the two prompts are independent
+        if self.extractor.has_memory_signal(conversation) or self.extractor.has_deletion_signal(conversation):
+            executor = ThreadPoolExecutor(max_workers=1)
+            analysis_future = executor.submit(
+                self.openai_client.analyze_turn, conversation, self.storage.get_all_contents()
+            )
+            executor.shutdown(wait=False)
+        else:
+            # Nothing to remember or forget in this turn
+            analysis_future = Future()
+            analysis_future.set_result({'new_memories': [], 'delete_ids': []})
+        
+        if stream:
+            result = {
+                'response': '',
+                'relevant_memories': relevant_memories,
+                'new_memories': [],
+                'deleted_memories': []
+            }
+            token_stream = self.openai_client.chat_completion_stream(
+                messages=conversation_with_memory,
+                model=model,
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+            result['response_stream'] = self._stream_response(token_stream, analysis_future, result)
+            return result
+        
         # Generate the response
         response = self.openai_client.chat_completion(
             messages=conversation_with_memory,
@@ -216,9 +546,11 @@ class MemorySystem:
             max_tokens=max_tokens
         )
         
+        applied = self._apply_analysis(self._analysis_result(analysis_future))
+        
         return {
             'response': response,
             'relevant_memories': relevant_memories,
-            'new_memories': process_result['new_memories'],
-            'deleted_memories': process_result['deleted_memories']
+            'new_memories': applied['new_memories'],
+            'deleted_memories': applied['deleted_memories']
         }
@@ -1,14 +1,104 @@
+import re
+import json
+import asyncio
+import hashlib
 import openai
 import numpy as np
-from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Words too common to say anything about which memories a message refers to
+_STOPWORDS = frozenset("""
+    the and for are but not you your yours with this that these those have has had was were
+    will would can could should about from into what when where which who whom why how
+    all any some just than then them they their there here our ours she him her his its
+    don anymore longer now like really very also please thanks thank
+""".split())
+
+_WORD = re.compile(r"[a-z0-9']{3,}")
+
+# System prompts are module-level constants so every request starts with a
+# byte-identical prefix, which lets OpenAI's automatic prompt caching reuse it.
+# Never interpolate dynamic content into them; it belongs in the user message.
+MEMORY_EXTRACTION_SYSTEM_PROMPT = """\
+You are an AI assistant that extracts important information from conversations to be stored as long-term memories.
+Your task is to identify statements that contain personal preferences, facts, or important information that the user might want to remember in the future.
+
+For each such statement, create a memory object with the following structure:
+{
+    "content": "The exact statement or a concise summary of the information",
+    "importance": a score from 1 to 10 indicating how important this memory is,
+    "category": a string categorizing the memory (e.g., "preference", "fact", "personal_info"),
+    "entities": a list of entities mentioned in the memory (e.g., ["Shram", "Magnet"])
+}
+
+Only extract information that seems personally relevant to the user and might be useful in future conversations.
+Ignore general knowledge, transient information, or casual conversation.
+
+Return your response as a JSON object of the form {"memories": [memory objects]}.
+"""
+
+MEMORY_DELETION_SYSTEM_PROMPT = """\
+You are an AI assistant that identifies memories to delete based on the user's input.
+Your task is to analyze the conversation and determine which memories should be deleted.
+
+The user might explicitly ask to delete memories (e.g., "I don't use Magnet anymore") or imply that certain information is no longer valid.
+
+For each memory, decide if it should be deleted based on the conversation.
+Return your response as a JSON object of the form {"delete_ids": [IDs of memories to delete]}.
+If no memories should be deleted, return {"delete_ids": []}.
+"""
+
+TURN_ANALYSIS_SYSTEM_PROMPT = """\
+You are an AI assistant that maintains a user's long-term memories based on their conversations.
+You have two tasks.
+
+1. Identify statements that contain personal preferences, facts, or important information that the user might want to remember in the future.
+For each such statement, create a memory object with the following structure:
+{
+    "content": "The exact statement or a concise summary of the information",
+    "importance": a score from 1 to 10 indicating how important this memory is,
+    "category": a string categorizing the memory (e.g., "preference", "fact", "personal_info"),
+    "entities": a list of entities mentioned in the memory (e.g., ["Shram", "Magnet"])
+}
+Only extract information that seems personally relevant to the user and might be useful in future conversations.
+Ignore general knowledge, transient information, or casual conversation.
+
+2. Determine which existing memories should be deleted.
+The user might explicitly ask to delete memories (e.g., "I don't use Magnet anymore") or imply that certain information is no longer valid.
+
+Return your response as a JSON object with two keys:
+{"new_memories": [memory objects], "delete_ids": [IDs of memories to delete]}
+Use empty arrays when there is nothing to add or delete.
+"""
 
 class OpenAIClient:
     """Client for interacting with OpenAI APIs."""
     
-    def __init__(self, api_key: str):
-        """Initialize the client with API key."""
+    def __init__(self, api_key: str, embedding_cache_size: int = 4096):
+        """
+        Initialize the client with API key.
+        
+        Args:
+            api_key: OpenAI API key.
+            embedding_cache_size: Maximum number of embeddings kept in the LRU cache.
+        """
         self.api_key = api_key
         openai.api_key = api_key
+        self.embedding_cache_size = embedding_cache_size
+        self._emb_cache: "OrderedDict[Tuple[str, bytes], np.ndarray]" = OrderedDict()
+    
+    def _cache_key(self, text: str, model: str) -> Tuple[str, bytes]:
+        """Build the embedding cache key for a text and model."""
+        return (model, hashlib.blake2b(text.encode(), digest_size=16).digest())
     
     def get_embedding(self, text: str, model: str = "text-embedding-ada-002") -> np.ndarray:
         """
@@ -21,11 +111,90 @@ class OpenAIClient:
         Returns:
             A numpy array representing the embedding.
         """
-        response = openai.Embedding.create(
-            model=model,
-            input=text
-        )
-        return np.array(response['data'][0]['embedding'])
+        return self.get_embeddings([text], model=model)[0]
+    
+    def get_embeddings(self, texts: List[str], 
+                       model: str = "text-embedding-ada-002") -> np.ndarray:
+        """
+        Get the embeddings for several texts with a single API request.
+        
+        Args:
+            texts: The texts to embed.
+            model: The OpenAI embedding model to use.
+            
+        Returns:
+            A (len(texts), D) numpy array with one embedding per row, in input order.
+        """
+        keys, embeddings, missing = self._lookup_embeddings(texts, model)
+        
+        # Fetch the remaining unique texts in one request
+        if missing:
+            response = openai.Embedding.create(
+                model=model,
+                input=list(missing.values())
+            )
+            self._cache_embeddings(response, embeddings, missing)
+        
+        return np.array([embeddings[key] for key in keys])
+    
+    async def aget_embeddings(self, texts: List[str], 
+                              model: str = "text-embedding-ada-002") -> np.ndarray:
+        """
+        Asynchronous version of get_embeddings, sharing its cache.
+        
+        Args:
+            texts: The texts to embed.
+            model: The OpenAI embedding model to use.
+            
+        Returns:
+            A (len(texts), D) numpy array with one embedding per row, in input order.
+        """
+        keys, embeddings, missing = self._lookup_embeddings(texts, model)
+        
+        if missing:
+            response = await openai.Embedding.acreate(
+                model=model,
+                input=list(missing.values())
+            )
+            self._cache_embeddings(response, embeddings, missing)
+        
+        return np.array([embeddings[key] for key in keys])
+    
+    def _lookup_embeddings(self, texts: List[str], model: str) -> Tuple[List[Tuple[str, bytes]], Dict[Tuple[str, bytes], np.ndarray], Dict[Tuple[str, bytes], str]]:
+        """
+        Serve what we can from the embedding cache.
+        
+        Returns:
+            The cache key for each text, the cached embeddings by key, and the
+            unique texts still to be fetched by key.
+        """
+        keys = [self._cache_key(text, model) for text in texts]
+        
+        embeddings = {}
+        for key in keys:
+            if key in self._emb_cache:
+                self._emb_cache.move_to_end(key)
+                embeddings[key] = self._emb_cache[key]
+        
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in embeddings:
+                missing.setdefault(key, text)
+        
+        return keys, embeddings, missing
+    
+    def _cache_embeddings(self, response: Dict[str, Any], embeddings: Dict[Tuple[str, bytes], np.ndarray], 
+                          missing: Dict[Tuple[str, bytes], str]) -> None:
+        """Add the embeddings from an API response to the results and the cache."""
+        data = sorted(response['data'], key=itemgetter('index'))
+        for key, item in zip(missing, data):
+            embedding = np.array(item['embedding'])
+            embeddings[key] = embedding
+            self._emb_cache[key] = embedding
+        
+        # Evict the least recently used entries
+        while len(self._emb_cache) > self.embedding_cache_size:
+            self._emb_cache.popitem(last=False)
     
     def chat_completion(self, messages: List[Dict[str, str]], model: str = "gpt-4", 
                        temperature: float = 0.7, max_tokens: int = 1000) -> str:
@@ -49,8 +218,34 @@ class OpenAIClient:
         )
         return response.choices[0].message['content']
     
+    def chat_completion_stream(self, messages: List[Dict[str, str]], model: str = "gpt-4", 
+                               temperature: float = 0.7, max_tokens: int = 1000) -> Iterator[str]:
+        """
+        Generate a chat completion response, yielding text as it arrives.
+        
+        Args:
+            messages: A list of message dictionaries with 'role' and 'content' keys.
+            model: The OpenAI model to use.
+            temperature: Controls randomness. Lower is more deterministic.
+            max_tokens: Maximum number of tokens to generate.
+            
+        Yields:
+            Pieces of the generated response text, in order.
+        """
+        response = openai.ChatCompletion.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        for chunk in response:
+            content = chunk['choices'][0]['delta'].get('content')
+            if content:
+                yield content
+    
     def extract_memories(self, conversation: List[Dict[str, str]], 
-                        model: str = "gpt-4") -> List[Dict[str, Any]]:
+                        model: str = "gpt-4o") -> List[Dict[str, Any]]:
         """
         Extract potential memories from a conversation.
         
@@ -61,85 +256,147 @@ class OpenAIClient:
         Returns:
             A list of dictionaries, each representing a potential memory.
         """
-        system_prompt = """
-        You are an AI assistant that extracts important information from conversations to be stored as long-term memories.
-        Your task is to identify statements that contain personal preferences, facts, or important information that the user might want to remember in the future.
-        
-        For each such statement, create a memory object with the following structure:
-        {
-            "content": "The exact statement or a concise summary of the information",
-            "importance": a score from 1 to 10 indicating how important this memory is,
-            "category": a string categorizing the memory (e.g., "preference", "fact", "personal_info"),
-            "entities": a list of entities mentioned in the memory (e.g., ["Shram", "Magnet"])
-        }
-        
-        Only extract information that seems personally relevant to the user and might be useful in future conversations.
-        Ignore general knowledge, transient information, or casual conversation.
+        response = openai.ChatCompletion.create(**self._extraction_request(conversation, model))
         
-        Return your response as a JSON array of memory objects.
+        # JSON mode guarantees a parseable object
+        return _json_loads(response.choices[0].message['content']).get('memories', [])
+    
+    async def aextract_memories(self, conversation: List[Dict[str, str]], 
+                                model: str = "gpt-4o") -> List[Dict[str, Any]]:
         """
+        Asynchronous version of extract_memories.
         
+        Args:
+            conversation: A list of message dictionaries with 'role' and 'content' keys.
+            model: The OpenAI model to use for extraction.
+            
+        Returns:
+            A list of dictionaries, each representing a potential memory.
+        """
+        response = await openai.ChatCompletion.acreate(**self._extraction_request(conversation, model))
+        return _json_loads(response.choices[0].message['content']).get('memories', [])
+    
+    def _extraction_request(self, conversation: List[Dict[str, str]], model: str) -> Dict[str, Any]:
+        """Build the chat completion arguments for memory extraction."""
         # Format the conversation for the prompt
         formatted_conversation = "\n".join([f"{msg['role']}: {msg['content']}" for msg in conversation])
         
-        # Create the full prompt
-        full_prompt = f"{system_prompt}\n\nConversation:\n{formatted_conversation}"
-        
-        # Call the OpenAI API
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
+        return {
+            'model': model,
+            'messages': [
+                {"role": "system", "content": MEMORY_EXTRACTION_SYSTEM_PROMPT},
                 {"role": "user", "content": formatted_conversation}
             ],
-            temperature=0.3  # Lower temperature for more consistent extraction
-        )
-        
-        # Parse the response
-        try:
-            import json
-            memories = json.loads(response.choices[0].message['content'])
-            return memories
-        except json.JSONDecodeError:
-            # If the response is not valid JSON, try to extract JSON from the text
-            content = response.choices[0].message['content']
-            start_idx = content.find('[')
-            end_idx = content.rfind(']') + 1
-            
-            if start_idx != -1 and end_idx != -1:
-                try:
-                    memories = json.loads(content[start_idx:end_idx])
-                    return memories
-                except json.JSONDecodeError:
-                    return []
-            else:
-                return []
+            'temperature': 0.3,  # Lower temperature for more consistent extraction
+            'response_format': {"type": "json_object"}
+        }
     
     def identify_memories_to_delete(self, conversation: List[Dict[str, str]], 
                                   memories: List[Dict[str, Any]], 
-                                  model: str = "gpt-4") -> List[int]:
+                                  model: str = "gpt-4o", 
+                                  max_memories_per_chunk: int = 200, 
+                                  max_workers: int = 8) -> List[int]:
         """
         Identify memories to delete based on the conversation.
         
+        Memories that don't fit in one prompt are first narrowed down to those
+        sharing a keyword with the user's messages, then split into chunks that
+        are sent concurrently.
+        
         Args:
             conversation: A list of message dictionaries with 'role' and 'content' keys.
             memories: A list of memory dictionaries.
             model: The OpenAI model to use for identification.
+            max_memories_per_chunk: Maximum number of memories sent in one request.
+            max_workers: Maximum number of concurrent requests.
             
         Returns:
             A list of memory IDs to delete.
         """
-        system_prompt = """
-        You are an AI assistant that identifies memories to delete based on the user's input.
-        Your task is to analyze the conversation and determine which memories should be deleted.
+        if not memories:
+            return []
+        
+        chunks = self._deletion_chunks(conversation, memories, max_memories_per_chunk)
+        if len(chunks) == 1:
+            return self._identify_chunk(conversation, chunks[0], model)
         
-        The user might explicitly ask to delete memories (e.g., "I don't use Magnet anymore") or imply that certain information is no longer valid.
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            results = list(executor.map(
+                lambda chunk: self._identify_chunk(conversation, chunk, model), chunks
+            ))
         
-        For each memory, decide if it should be deleted based on the conversation.
-        Return your response as a JSON array of memory IDs that should be deleted.
-        If no memories should be deleted, return an empty array.
+        # Merge the IDs from every chunk, keeping the first occurrence
+        return list(dict.fromkeys(memory_id for result in results for memory_id in result))
+    
+    async def aidentify_memories_to_delete(self, conversation: List[Dict[str, str]], 
+                                           memories: List[Dict[str, Any]], 
+                                           model: str = "gpt-4o", 
+                                           max_memories_per_chunk: int = 200) -> List[int]:
         """
+        Asynchronous version of identify_memories_to_delete; chunks are awaited concurrently.
         
+        Args:
+            conversation: A list of message dictionaries with 'role' and 'content' keys.
+            memories: A list of memory dictionaries.
+            model: The OpenAI model to use for identification.
+            max_memories_per_chunk: Maximum number of memories sent in one request.
+            
+        Returns:
+            A list of memory IDs to delete.
+        """
+        if not memories:
+            return []
+        
+        chunks = self._deletion_chunks(conversation, memories, max_memories_per_chunk)
+        responses = await asyncio.gather(*[
+            openai.ChatCompletion.acreate(**self._deletion_request(conversation, chunk, model))
+            for chunk in chunks
+        ])
+        
+        results = [
+            _json_loads(response.choices[0].message['content']).get('delete_ids', [])
+            for response in responses
+        ]
+        return list(dict.fromkeys(memory_id for result in results for memory_id in result))
+    
+    def _deletion_chunks(self, conversation: List[Dict[str, str]], 
+                         memories: List[Dict[str, Any]], 
+                         max_memories_per_chunk: int) -> List[List[Dict[str, Any]]]:
+        """Narrow down the memories if needed and split them into prompt-sized chunks."""
+        if len(memories) > max_memories_per_chunk:
+            candidates = self._filter_by_keywords(conversation, memories)
+            if candidates:
+                memories = candidates
+        
+        return [
+            memories[i:i + max_memories_per_chunk]
+            for i in range(0, len(memories), max_memories_per_chunk)
+        ]
+    
+    def _filter_by_keywords(self, conversation: List[Dict[str, str]], 
+                            memories: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Return the memories that share a non-trivial word with the user's messages."""
+        keywords = set()
+        for msg in conversation:
+            if msg['role'] == 'user':
+                keywords.update(_WORD.findall(msg['content'].lower()))
+        keywords -= _STOPWORDS
+        
+        return [
+            memory for memory in memories
+            if keywords.intersection(_WORD.findall(memory['content'].lower()))
+        ]
+    
+    def _identify_chunk(self, conversation: List[Dict[str, str]], 
+                        memories: List[Dict[str, Any]], 
+                        model: str) -> List[int]:
+        """Ask the model which of a single chunk of memories should be deleted."""
+        response = openai.ChatCompletion.create(**self._deletion_request(conversation, memories, model))
+        return _json_loads(response.choices[0].message['content']).get('delete_ids', [])
+    
+    def _format_turn_prompt(self, conversation: List[Dict[str, str]], 
+                            memories: List[Dict[str, Any]]) -> str:
+        """Format a conversation and a list of memories as the user message of a request."""
         # Format the conversation for the prompt
         formatted_conversation = "\n".join([f"{msg['role']}: {msg['content']}" for msg in conversation])
         
@@ -149,35 +406,82 @@ class OpenAIClient:
             formatted_memories.append(f"ID: {memory['id']}, Content: {memory['content']}")
         formatted_memories_str = "\n".join(formatted_memories)
         
-        # Create the full prompt
-        full_prompt = f"{system_prompt}\n\nConversation:\n{formatted_conversation}\n\nMemories:\n{formatted_memories_str}"
-        
-        # Call the OpenAI API
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": full_prompt}
+        return f"Conversation:\n{formatted_conversation}\n\nMemories:\n{formatted_memories_str}"
+    
+    def _deletion_request(self, conversation: List[Dict[str, str]], 
+                          memories: List[Dict[str, Any]], model: str) -> Dict[str, Any]:
+        """Build the chat completion arguments for identifying deletions in one chunk."""
+        return {
+            'model': model,
+            'messages': [
+                {"role": "system", "content": MEMORY_DELETION_SYSTEM_PROMPT},
+                {"role": "user", "content": self._format_turn_prompt(conversation, memories)}
             ],
-            temperature=0.3  # Lower temperature for more consistent identification
-        )
+            'temperature': 0.3,  # Lower temperature for more consistent identification
+            'response_format': {"type": "json_object"}
+        }
+    
+    def analyze_turn(self, conversation: List[Dict[str, str]], 
+                     memories: List[Dict[str, Any]], 
+                     model: str = "gpt-4o", 
+                     max_memories_per_chunk: int = 200, 
+                     max_workers: int = 8) -> Dict[str, List[Any]]:
+        """
+        Extract new memories and identify memories to delete with a single call.
+        
+        Memories that don't fit in one prompt are narrowed down and chunked as in
+        identify_memories_to_delete; the first chunk goes with the analysis
+        request and the rest are sent concurrently as deletion requests.
         
-        # Parse the response
-        try:
-            import json
-            memory_ids_to_delete = json.loads(response.choices[0].message['content'])
-            return memory_ids_to_delete
-        except json.JSONDecodeError:
-            # If the response is not valid JSON, try to extract JSON from the text
-            content = response.choices[0].message['content']
-            start_idx = content.find('[')
-            end_idx = content.rfind(']') + 1
+        Args:
+            conversation: A list of message dictionaries with 'role' and 'content' keys.
+            memories: A list of existing memory dictionaries.
+            model: The OpenAI model to use.
+            max_memories_per_chunk: Maximum number of memories sent in one request.
+            max_workers: Maximum number of concurrent requests.
             
-            if start_idx != -1 and end_idx != -1:
-                try:
-                    memory_ids_to_delete = json.loads(content[start_idx:end_idx])
-                    return memory_ids_to_delete
-                except json.JSONDecodeError:
-                    return []
-            else:
-                return []
+        Returns:
+            A dictionary with 'new_memories' (a list of memory dictionaries) and
+            'delete_ids' (a list of memory IDs to delete).
+        """
+        chunks = self._deletion_chunks(conversation, memories, max_memories_per_chunk) if memories else [[]]
+        if len(chunks) == 1:
+            return self._analyze_chunk(conversation, chunks[0], model)
+        
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            analysis_future = executor.submit(self._analyze_chunk, conversation, chunks[0], model)
+            results = list(executor.map(
+                lambda chunk: self._identify_chunk(conversation, chunk, model), chunks[1:]
+            ))
+            analysis = analysis_future.result()
+        
+        # Merge the IDs from every chunk, keeping the first occurrence
+        analysis['delete_ids'] = list(dict.fromkeys(
+            [*analysis['delete_ids'], *(memory_id for result in results for memory_id in result)]
+        ))
+        return analysis
+    
+    def _analyze_chunk(self, conversation: List[Dict[str, str]], 
+                       memories: List[Dict[str, Any]], 
+                       model: str) -> Dict[str, List[Any]]:
+        """Run the combined extraction and deletion analysis over a single chunk of memories."""
+        response = openai.ChatCompletion.create(**self._analysis_request(conversation, memories, model))
+        analysis = _json_loads(response.choices[0].message['content'])
+        
+        return {
+            'new_memories': analysis.get('new_memories') or [],
+            'delete_ids': analysis.get('delete_ids') or []
+        }
+    
+    def _analysis_request(self, conversation: List[Dict[str, str]], 
+                          memories: List[Dict[str, Any]], model: str) -> Dict[str, Any]:
+        """Build the chat completion arguments for analyzing a turn against one chunk."""
+        return {
+            'model': model,
+            'messages': [
+                {"role": "system", "content": TURN_ANALYSIS_SYSTEM_PROMPT},
+                {"role": "user", "content": self._format_turn_prompt(conversation, memories)}
+            ],
+            'temperature': 0.3,  # Lower temperature for more consistent results
+            'response_format': {"type": "json_object"}
+        }
@@ -1,62 +1,317 @@
+import os
+import threading
+from contextlib import suppress
 import numpy as np
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 from .openai_client import OpenAIClient
+from .kernels import normalize, normalize_rows, dot_scores
+from .storage import count_tokens
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# Below this many memories an exact flat index is both faster and exact
+HNSW_MIN_MEMORIES = 10000
+
+# Queries scored per matrix product in batched retrieval, keeping each score
+# block small enough to stay in cache
+QUERY_BLOCK_SIZE = 64
+
+# Maximum number of memory tokens added to the chat prompt
+DEFAULT_CONTEXT_TOKEN_BUDGET = 1500
 
 class MemoryRetriever:
     """Retrieves relevant memories based on context."""
     
-    def __init__(self, openai_client: OpenAIClient):
-        """Initialize with an OpenAI client."""
+    def __init__(self, openai_client: OpenAIClient, index_path: Optional[str] = None, 
+                 quantize: bool = False):
+        """
+        Initialize with an OpenAI client.
+        
+        Args:
+            openai_client: The client used to embed queries.
+            index_path: Optional path where the FAISS index is persisted.
+            quantize: Whether the FAISS index stores embeddings as 8-bit scalars,
+                trading a little recall for 4x less memory traffic per query.
+        """
         self.openai_client = openai_client
+        self.index_path = index_path
+        self.quantize = quantize
+        self.index = None
+        # Storage write generation of the embeddings the index is built from,
+        # set by the caller; a persisted index is only reused at the same one
+        self.index_generation: Optional[int] = None
+        # Whether the index has changed since it was last read or written
+        self._index_dirty = False
+        # Guards the FAISS index, which may be built lazily from several threads
+        self._index_lock = threading.RLock()
     
-    def retrieve_relevant_memories(self, query: str, memories: List[Dict[str, Any]], 
-                                 limit: int = 5) -> List[Dict[str, Any]]:
+    def _create_index(self, dim: int, size: int):
+        """Create an empty inner-product FAISS index suited to the collection size."""
+        if size < HNSW_MIN_MEMORIES:
+            if self.quantize:
+                return faiss.IndexScalarQuantizer(
+                    dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+                )
+            return faiss.IndexFlatIP(dim)
+        
+        if self.quantize:
+            index = faiss.IndexHNSWSQ(
+                dim, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT
+            )
+        else:
+            index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 200
+        index.hnsw.efSearch = 64
+        return index
+    
+    def _index_ids(self) -> np.ndarray:
+        """Return the memory IDs held by the FAISS index."""
+        return faiss.vector_to_array(self.index.id_map)
+    
+    def build_index(self, emb_matrix: np.ndarray, row_to_id: np.ndarray) -> None:
+        """
+        Build a FAISS index over the embedding matrix, if FAISS is installed.
+        
+        A persisted index is reused when it was saved at index_generation and
+        holds exactly the given memory IDs.
+        
+        Args:
+            emb_matrix: A (N, D) float32 matrix of L2-normalized memory embeddings.
+            row_to_id: An array of the memory ID for each row of emb_matrix.
+        """
+        with self._index_lock:
+            self._build_index(emb_matrix, row_to_id)
+    
+    def _build_index(self, emb_matrix: np.ndarray, row_to_id: np.ndarray) -> None:
+        """Build the FAISS index; the caller holds the index lock."""
+        self.index = None
+        self._index_dirty = False
+        if faiss is None or not len(row_to_id):
+            return
+        
+        ids = np.asarray(row_to_id, dtype=np.int64)
+        matrix = np.ascontiguousarray(emb_matrix, dtype=np.float32)
+        base = self._create_index(matrix.shape[1], len(row_to_id))
+        
+        if self.index_generation is not None and self._persisted_generation() == self.index_generation:
+            self.index = faiss.read_index(self.index_path)
+            if (
+                self.index.d == matrix.shape[1]
+                and type(faiss.downcast_index(self.index.index)) is type(base)
+                and np.array_equal(np.sort(self._index_ids()), np.sort(ids))
+            ):
+                return
+        
+        self.index = faiss.IndexIDMap2(base)
+        if not self.index.is_trained:
+            # Learn the per-dimension ranges of the 8-bit quantizer
+            self.index.train(matrix)
+        self.index.add_with_ids(matrix, ids)
+        self._index_dirty = True
+        self._save_index()
+    
+    def _persisted_generation(self) -> Optional[int]:
+        """Return the write generation the persisted index was saved at, if it was saved completely."""
+        if not self.index_path or not os.path.exists(self.index_path):
+            return None
+        try:
+            with open(f"{self.index_path}.generation") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+    
+    def save_index(self) -> None:
+        """Write the FAISS index to index_path if it changed since it was last read or written."""
+        with self._index_lock:
+            self._save_index()
+    
+    def _save_index(self) -> None:
+        """Persist the FAISS index; the caller holds the index lock."""
+        if self.index is None or not self.index_path or not self._index_dirty:
+            return
+        
+        # The stamp is written last, so a partly written index never matches
+        stamp_path = f"{self.index_path}.generation"
+        with suppress(FileNotFoundError):
+            os.remove(stamp_path)
+        faiss.write_index(self.index, self.index_path)
+        if self.index_generation is not None:
+            with open(stamp_path, 'w') as f:
+                f.write(str(self.index_generation))
+        self._index_dirty = False
+    
+    def add_to_index(self, memory_id: int, embedding: np.ndarray) -> None:
+        """Add a normalized embedding to the FAISS index, if one is built."""
+        with self._index_lock:
+            if self.index is None:
+                return
+            
+            self.index.add_with_ids(
+                np.ascontiguousarray(embedding[None, :], dtype=np.float32),
+                np.array([memory_id], dtype=np.int64)
+            )
+            self._index_dirty = True
+    
+    def invalidate_index(self) -> None:
+        """Drop the FAISS index so the next query rebuilds it from the embedding matrix."""
+        with self._index_lock:
+            self.index = None
+    
+    def remove_from_index(self, memory_id: int) -> None:
+        """Remove a memory from the FAISS index, if one is built."""
+        with self._index_lock:
+            if self.index is None:
+                return
+            
+            try:
+                self.index.remove_ids(np.array([memory_id], dtype=np.int64))
+                self._index_dirty = True
+            except RuntimeError:
+                # HNSW does not support removal; rebuild on the next query
+                self.index = None
+    
+    def retrieve_relevant_memories(self, query: str, emb_matrix: np.ndarray, 
+                                 row_to_id: np.ndarray, 
+                                 limit: int = 5) -> List[Tuple[int, float]]:
         """
         Retrieve memories relevant to the given query.
         
         Args:
             query: The query to find relevant memories for.
-            memories: A list of memory dictionaries.
+            emb_matrix: A (N, D) float32 matrix of L2-normalized memory embeddings.
+            row_to_id: An array of the memory ID for each row of emb_matrix.
             limit: Maximum number of memories to return.
             
         Returns:
-            A list of memory dictionaries, sorted by relevance.
+            A list of (memory_id, similarity) tuples, sorted by relevance.
         """
-        # Get the embedding for the query
-        query_embedding = self.openai_client.get_embedding(query)
+        if not len(row_to_id) or limit <= 0:
+            return []
         
-        # Calculate similarity with each memory
-        for memory in memories:
-            if 'embedding' in memory and memory['embedding'] is not None:
-                memory_embedding = memory['embedding']
-                # Calculate cosine similarity
-                similarity = np.dot(query_embedding, memory_embedding) / (
-                    np.linalg.norm(query_embedding) * np.linalg.norm(memory_embedding)
-                )
-                memory['similarity'] = similarity
-            else:
-                memory['similarity'] = 0.0
+        # Get the normalized embedding for the query
+        query_embedding = normalize(
+            np.asarray(self.openai_client.get_embedding(query), dtype=np.float32)
+        )
+        
+        if faiss is not None:
+            with self._index_lock:
+                if self.index is None:
+                    self._build_index(emb_matrix, row_to_id)
+                scores, ids = self.index.search(query_embedding[None, :], limit)
+            return [
+                (int(memory_id), float(score))
+                for memory_id, score in zip(ids[0], scores[0])
+                if memory_id != -1
+            ]
+        
+        # Rows are unit-length, so cosine similarity is a single matrix-vector product
+        similarities = dot_scores(emb_matrix, query_embedding)
+        
+        # Select the top 'limit' rows without sorting the whole array
+        if limit < len(row_to_id):
+            top_idx = np.argpartition(-similarities, limit - 1)[:limit]
+        else:
+            top_idx = np.arange(len(row_to_id))
+        top_idx = top_idx[np.argsort(-similarities[top_idx])]
+        
+        return [(int(row_to_id[i]), float(similarities[i])) for i in top_idx]
+    
+    def retrieve_relevant_memories_batched(self, queries: List[str], emb_matrix: np.ndarray, 
+                                         row_to_id: np.ndarray, 
+                                         limit: int = 5) -> List[List[Tuple[int, float]]]:
+        """
+        Retrieve memories relevant to each of several queries.
+        
+        All queries are embedded with one request and scored against the
+        memories with one matrix-matrix product per block of queries.
+        
+        Args:
+            queries: The queries to find relevant memories for.
+            emb_matrix: A (N, D) float32 matrix of L2-normalized memory embeddings.
+            row_to_id: An array of the memory ID for each row of emb_matrix.
+            limit: Maximum number of memories to return per query.
+            
+        Returns:
+            For each query, a list of (memory_id, similarity) tuples sorted by relevance.
+        """
+        if not queries:
+            return []
+        if not len(row_to_id) or limit <= 0:
+            return [[] for _ in queries]
+        
+        # Get the normalized embeddings for all queries with a single request
+        query_matrix = normalize_rows(
+            np.asarray(self.openai_client.get_embeddings(queries), dtype=np.float32)
+        )
+        
+        if faiss is not None:
+            with self._index_lock:
+                if self.index is None:
+                    self._build_index(emb_matrix, row_to_id)
+                scores, ids = self.index.search(query_matrix, limit)
+            return [
+                [
+                    (int(memory_id), float(score))
+                    for memory_id, score in zip(row_ids, row_scores)
+                    if memory_id != -1
+                ]
+                for row_ids, row_scores in zip(ids, scores)
+            ]
+        
+        limit = min(limit, len(row_to_id))
+        results = []
+        for start in range(0, len(queries), QUERY_BLOCK_SIZE):
+            # One (B, N) block of similarities per matrix product
+            similarities = query_matrix[start:start + QUERY_BLOCK_SIZE] @ emb_matrix.T
+            
+            # Select the top 'limit' rows per query without sorting whole rows
+            top_idx = np.argpartition(-similarities, limit - 1, axis=1)[:, :limit]
+            top_scores = np.take_along_axis(similarities, top_idx, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            top_idx = np.take_along_axis(top_idx, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            
+            results.extend(
+                [(int(row_to_id[i]), float(score)) for i, score in zip(row_idx, row_scores)]
+                for row_idx, row_scores in zip(top_idx, top_scores)
+            )
         
-        # Sort by similarity (descending) and return the top 'limit' memories
-        memories.sort(key=lambda x: x['similarity'], reverse=True)
-        return memories[:limit]
+        return results
     
-    def format_memories_for_context(self, memories: List[Dict[str, Any]]) -> str:
+    def format_memories_for_context(self, memories: List[Dict[str, Any]], 
+                                  token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET) -> str:
         """
         Format memories for inclusion in a conversation context.
         
+        Memories are packed in the given order, so pass them ranked by relevance;
+        packing stops at the first memory that would exceed the token budget.
+        
         Args:
-            memories: A list of memory dictionaries.
+            memories: A list of memory dictionaries, most relevant first.
+            token_budget: Maximum number of memory tokens to include.
             
         Returns:
             A string containing the formatted memories.
         """
-        if not memories:
-            return "No relevant memories found."
-        
         formatted_memories = []
+        used_tokens = 0
         for memory in memories:
             content = memory.get('content', '')
+            
+            # Use the count stored at insert time when available
+            tokens = memory.get('token_count')
+            if tokens is None:
+                tokens = count_tokens(content)
+            
+            used_tokens += tokens
+            if used_tokens > token_budget:
+                break
             formatted_memories.append(f"- {content}")
         
+        if not formatted_memories:
+            return "No relevant memories found."
+        
         return "Relevant memories:\n" + "\n".join(formatted_memories)
@@ -1,39 +1,629 @@
+import re
 import sqlite3
+import os
 import json
+import hashlib
+import functools
+import threading
 import numpy as np
-from datetime import datetime
-from typing import List, Dict, Any, Optional, Tuple
+from contextlib import contextmanager, suppress
+from pathlib import Path
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+
+from .kernels import (
+    normalize, normalize_rows, cosine_scores, int8_dot_scores, lsh_signatures, hamming_distances
+)
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+    
+    def _json_dumps(obj: Any) -> str:
+        """Serialize to a JSON string; non-string keys are converted like json.dumps does."""
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    import sqlite_vec
+except ImportError:
+    sqlite_vec = None
+
+# Python builds without extension loading can't use sqlite-vec
+if not hasattr(sqlite3.Connection, "enable_load_extension"):
+    sqlite_vec = None
+
+# Current Unix time in whole seconds; unlike unixepoch() it works before SQLite 3.38
+_NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+# Prepared statements kept per connection, above sqlite3's default of 128
+STATEMENT_CACHE_SIZE = 256
+
+# Initial row capacity of the in-memory embedding copy; it doubles when full
+INITIAL_EMBEDDING_CAPACITY = 1024
+
+# With the LSH prefilter, the closest signatures are scored exactly for
+# this many candidates per requested result
+LSH_CANDIDATES_PER_RESULT = 10
+
+def content_hash(content: str) -> bytes:
+    """
+    Hash memory content for duplicate detection.
+    
+    Content is compared case-insensitively and ignoring surrounding whitespace.
+    
+    Args:
+        content: The text content of a memory.
+        
+    Returns:
+        A 16-byte digest of the normalized content.
+    """
+    data = content.strip().lower().encode()
+    if xxhash is not None:
+        return xxhash.xxh3_128_digest(data)
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding():
+    """Load the GPT-4 tokenizer once per process."""
+    return tiktoken.encoding_for_model("gpt-4")
+
+def count_tokens(content: str) -> int:
+    """
+    Count the prompt tokens a memory's content takes up.
+    
+    Uses the GPT-4 tokenizer when tiktoken is installed, and otherwise
+    estimates roughly four characters per token.
+    
+    Args:
+        content: The text content of a memory.
+        
+    Returns:
+        The number of tokens in the content.
+    """
+    if tiktoken is not None:
+        return len(_get_encoding().encode(content))
+    return (len(content) + 3) // 4
+
+def quantize_int8(vector: np.ndarray) -> Tuple[np.ndarray, float]:
+    """
+    Quantize a vector to int8 with a symmetric per-vector scale.
+    
+    Args:
+        vector: The vector to quantize.
+        
+    Returns:
+        The int8 vector and its scale, such that vector ≈ quantized * scale.
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    peak = float(np.max(np.abs(vector))) if vector.size else 0.0
+    scale = peak / 127.0 if peak > 0 else 1.0
+    return np.round(vector / scale).astype(np.int8), scale
+
+def quantize_int8_rows(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantize every row of a matrix to int8 with its own symmetric scale.
+    
+    Args:
+        matrix: A (N, D) matrix of vectors.
+        
+    Returns:
+        The (N, D) int8 matrix and the N row scales, as in quantize_int8.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    peaks = np.max(np.abs(matrix), axis=1) if matrix.size else np.zeros(len(matrix), np.float32)
+    scales = np.where(peaks > 0, peaks / 127.0, 1.0).astype(np.float32)
+    return np.round(matrix / scales[:, None]).astype(np.int8), scales
+
+@functools.lru_cache(maxsize=None)
+def _lsh_projection(dim: int) -> np.ndarray:
+    """Return the fixed random hyperplanes for 64-bit LSH signatures of dim-dimensional embeddings."""
+    # Seeded, so signatures agree across sessions
+    return np.random.default_rng(0).standard_normal((dim, 64)).astype(np.float32)
+
+def _fts_query(query: str) -> str:
+    """Build an FTS5 query matching every word of free text as a prefix."""
+    # Quoting each word keeps FTS5 syntax characters in the text from being interpreted
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', query))
 
 class MemoryStorage:
-    """Handles efficient storage and retrieval of conversation memories."""
+    """
+    Handles efficient storage and retrieval of conversation memories.
     
-    def __init__(self, db_path: str = "memories.db"):
-        """Initialize the storage with a SQLite database."""
+    Embeddings are stored scaled to unit length, so cosine similarity
+    between stored embeddings is a plain dot product. Timestamps are Unix
+    times in whole seconds.
+    """
+    
+    def __init__(self, db_path: str = "memories.db", embedding_dtype: Any = None, 
+                 quantized_search: bool = False, lsh_prefilter: bool = False, 
+                 new_embedding_dtype: Any = np.float32):
+        """
+        Initialize the storage with a SQLite database.
+        
+        find_similar_memories searches with sqlite-vec when it is installed,
+        unless quantized_search or lsh_prefilter asks for a scan of the
+        in-memory embedding copy.
+        
+        Args:
+            db_path: Path to the SQLite database file.
+            embedding_dtype: NumPy dtype used to store embeddings, e.g. np.float16
+                to halve the bytes read per memory. It is recorded when the
+                database is created, and opening the database with a different
+                dtype raises ValueError. None uses the recorded dtype, or
+                new_embedding_dtype for a new database.
+            quantized_search: Whether find_similar_memories scores the int8 copies
+                of the embeddings, reading 4x fewer bytes than float32 at a
+                small cost in precision.
+            lsh_prefilter: Whether find_similar_memories first narrows the search
+                to the memories with the closest 64-bit LSH signatures and only
+                scores those exactly. Much faster on large stores, at the cost
+                of occasionally missing a close match.
+            new_embedding_dtype: NumPy dtype a new database stores embeddings in
+                when embedding_dtype is None. Existing databases keep theirs.
+        """
         self.db_path = db_path
-        self._initialize_db()
+        self.quantized_search = quantized_search
+        self.lsh_prefilter = lsh_prefilter
+        
+        # One long-lived writer connection in autocommit mode; writes take the
+        # lock and group their statements in an explicit transaction. The lock is
+        # reentrant so loading the embedding copy can migrate rows it reads.
+        self._conn = self._connect(db_path)
+        self._lock = threading.RLock()
+        
+        # In-memory copy of the stored embeddings for find_similar_memories:
+        # loaded on first use, then kept in step with every write. Rows are
+        # preallocated with capacity doubling and filled up to _emb_count.
+        self._emb_loaded = False
+        self._emb_ids = np.zeros(0, dtype=np.int64)
+        self._emb_matrix = np.zeros((0, 0), dtype=np.float32)
+        self._emb_scales = np.zeros(0, dtype=np.float32)
+        self._emb_signatures = np.zeros(0, dtype=np.uint64)
+        self._emb_count = 0
+        self._emb_rows: Dict[int, int] = {}
+        
+        # Write generation the embedding copy reflects, and that of the
+        # snapshot it was loaded from, if any
+        self._emb_generation: Optional[int] = None
+        self._snapshot_generation: Optional[int] = None
+        
+        # Dimension of the sqlite-vec mirror table, once it exists
+        self._vec_dim: Optional[int] = None
+        
+        try:
+            self._initialize_db(embedding_dtype, new_embedding_dtype)
+        except BaseException:
+            self._conn.close()
+            raise
+        
+        # Decode embeddings in sqlite3 itself: selecting the embedding column as
+        # "embedding [<converter>]" yields an array aliasing the row's bytes
+        converter = f"embedding_{self.embedding_dtype.name}"
+        sqlite3.register_converter(converter, functools.partial(np.frombuffer, dtype=self.embedding_dtype))
+        self._memory_columns = (
+            f'id, content, embedding AS "embedding [{converter}]", '
+            'created_at, updated_at, metadata, token_count'
+        )
+        
+        # Hot queries are built once so every call hits the statement cache with
+        # the same SQL; ID lists are bound as one JSON array rather than
+        # expanded into a statement per list length
+        self._sql_get_memory = f'SELECT {self._memory_columns} FROM memories WHERE id = ?'
+        self._sql_get_memories_by_ids = (
+            f'SELECT {self._memory_columns} FROM memories '
+            'WHERE id IN (SELECT value FROM json_each(?))'
+        )
+        self._sql_get_all_memories = (
+            f'SELECT {self._memory_columns} FROM memories ORDER BY created_at DESC, id DESC'
+        )
+        self._sql_search_by_content = f'''
+            SELECT {self._memory_columns}
+            FROM (
+                SELECT rowid AS match_id, rank AS match_rank
+                FROM memories_fts
+                WHERE memories_fts MATCH ?
+                ORDER BY rank
+                LIMIT ?
+            )
+            JOIN memories ON memories.id = match_id
+            ORDER BY match_rank
+        '''
+        
+        # WAL lets a separate read-only connection read alongside the writer
+        if db_path == ":memory:":
+            self._reader, self._read_lock = self._conn, self._lock
+        else:
+            self._reader = self._connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+            self._read_lock = threading.Lock()
+        self._reader.row_factory = sqlite3.Row
+    
+    def _connect(self, database: str, uri: bool = False) -> sqlite3.Connection:
+        """Open a connection with the per-connection performance pragmas applied."""
+        conn = sqlite3.connect(
+            database, uri=uri, check_same_thread=False, isolation_level=None,
+            detect_types=sqlite3.PARSE_COLNAMES, cached_statements=STATEMENT_CACHE_SIZE
+        )
+        # WAL only needs a full sync at checkpoints, so NORMAL stays crash-safe
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        
+        if sqlite_vec is not None:
+            conn.enable_load_extension(True)
+            sqlite_vec.load(conn)
+            conn.enable_load_extension(False)
+        return conn
+    
+    @contextmanager
+    def _write(self) -> Iterator[sqlite3.Connection]:
+        """Run the enclosed statements in one write transaction on the writer connection."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            changes = self._conn.total_changes
+            try:
+                yield self._conn
+                if self._conn.total_changes != changes:
+                    self._bump_generation()
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                # The embedding copy and dimension may hold rolled-back changes
+                self._emb_loaded = False
+                self.embedding_dim = None
+                raise
+            self._conn.execute("COMMIT")
+    
+    def _generation(self) -> int:
+        """Return the database's write generation; the caller holds the writer lock."""
+        return self._conn.execute("SELECT value FROM storage_meta WHERE key = 'generation'").fetchone()[0]
     
-    def _initialize_db(self) -> None:
-        """Create the necessary tables if they don't exist."""
-        with sqlite3.connect(self.db_path) as conn:
+    def _bump_generation(self) -> None:
+        """Count a write transaction that changed rows, so stale embedding copies can be detected."""
+        generation = self._generation()
+        self._conn.execute(
+            "UPDATE storage_meta SET value = ? WHERE key = 'generation'", (generation + 1,)
+        )
+        # A copy that was current before the write was updated along with it
+        if self._emb_generation == generation:
+            self._emb_generation = generation + 1
+        if sqlite_vec is not None:
+            # So was the sqlite-vec mirror, which every write here maintains
+            self._conn.execute(
+                "UPDATE storage_meta SET value = ? WHERE key = 'vec_generation' AND value = ?",
+                (generation + 1, generation)
+            )
+    
+    @contextmanager
+    def _read(self) -> Iterator[sqlite3.Connection]:
+        """Provide the read-only connection."""
+        with self._read_lock:
+            yield self._reader
+    
+    def close(self) -> None:
+        """Save the embedding copy for the next session and close the database connections."""
+        with self._lock:
+            self._save_embedding_snapshot()
+        
+        if self._reader is not self._conn:
+            self._reader.close()
+        self._conn.close()
+    
+    def _embedding_bytes(self, embedding: np.ndarray) -> bytes:
+        """Normalize an embedding to unit length and encode it in the storage dtype."""
+        return normalize(np.asarray(embedding, dtype=np.float32)).astype(self.embedding_dtype).tobytes()
+    
+    def _row_to_memory(self, row: sqlite3.Row, include_metadata: bool = True) -> Dict[str, Any]:
+        """Build a memory dictionary from a row selected with self._memory_columns."""
+        # Parse metadata JSON
+        metadata = row['metadata']
+        if metadata is not None:
+            metadata = _json_loads(metadata) if include_metadata else None
+        
+        return {
+            'id': row['id'],
+            'content': row['content'],
+            'embedding': row['embedding'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at'],
+            'metadata': metadata,
+            'token_count': row['token_count']
+        }
+    
+    def _quantized_columns(self, embedding_bytes: Optional[bytes]) -> Tuple[Optional[bytes], Optional[float]]:
+        """Return the int8 copy and scale stored alongside an encoded embedding."""
+        if embedding_bytes is None:
+            return None, None
+        
+        quantized, scale = quantize_int8(np.frombuffer(embedding_bytes, dtype=self.embedding_dtype))
+        return quantized.tobytes(), scale
+    
+    def _initialize_db(self, embedding_dtype: Any, new_embedding_dtype: Any) -> None:
+        """Create the necessary tables if they don't exist and settle the embedding dtype."""
+        # Write-ahead logging is persistent, so it only needs to be enabled once
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        
+        with self._write() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
+            cursor.execute(f'''
                 CREATE TABLE IF NOT EXISTS memories (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     content TEXT NOT NULL,
+                    content_hash BLOB,
+                    token_count INTEGER,
                     embedding BLOB,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    embedding_i8 BLOB,
+                    embedding_scale REAL,
+                    created_at INTEGER DEFAULT ({_NOW}),
+                    updated_at INTEGER DEFAULT ({_NOW}),
                     metadata TEXT
                 )
             ''')
             
-            # Create an index for faster similarity searches
+            # Add the content hash column to databases created before it existed
+            columns = [row[1] for row in cursor.execute('PRAGMA table_info(memories)')]
+            if 'content_hash' not in columns:
+                cursor.execute('ALTER TABLE memories ADD COLUMN content_hash BLOB')
+            if 'embedding_i8' not in columns:
+                # Existing rows are quantized when the search matrix is built
+                cursor.execute('ALTER TABLE memories ADD COLUMN embedding_i8 BLOB')
+                cursor.execute('ALTER TABLE memories ADD COLUMN embedding_scale REAL')
+            if 'token_count' not in columns:
+                cursor.execute('ALTER TABLE memories ADD COLUMN token_count INTEGER')
+                cursor.execute('SELECT id, content FROM memories')
+                cursor.executemany(
+                    'UPDATE memories SET token_count = ? WHERE id = ?',
+                    [(count_tokens(content), memory_id) for memory_id, content in cursor.fetchall()]
+                )
+            
+            cursor.execute('CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value)')
+            cursor.execute("INSERT OR IGNORE INTO storage_meta (key, value) VALUES ('generation', 0)")
+            self.embedding_dtype = self._resolve_embedding_dtype(cursor, embedding_dtype, new_embedding_dtype)
+            self.embedding_dim = self._resolve_embedding_dim(cursor)
+            
+            # Identical content is stored only once
             cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_memories_embedding 
-                ON memories(embedding)
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_memories_content_hash 
+                ON memories(content_hash)
             ''')
             
-            conn.commit()
+            # Hash the content of rows written before it was hashed. Only the
+            # oldest row of each content gets the hash, so new writes match it;
+            # later duplicates keep a NULL hash rather than being deleted
+            cursor.execute('SELECT id, content FROM memories WHERE content_hash IS NULL ORDER BY id')
+            hashes = {}
+            for memory_id, content in cursor.fetchall():
+                hashes.setdefault(content_hash(content), memory_id)
+            cursor.executemany(
+                '''
+                UPDATE memories SET content_hash = ?1
+                WHERE id = ?2 AND NOT EXISTS (SELECT 1 FROM memories WHERE content_hash = ?1)
+                ''',
+                hashes.items()
+            )
+            
+            # An index on the embedding blob can't help similarity search and
+            # only slows down writes
+            cursor.execute('DROP INDEX IF EXISTS idx_memories_embedding')
+            
+            # Serve newest-first listings straight from an index
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_memories_created_at 
+                ON memories(created_at DESC, id DESC)
+            ''')
+            
+            # Convert the text timestamps of rows written before they were Unix
+            # times; text sorts above numbers, so the index finds any in one step
+            cursor.execute('SELECT typeof(created_at) FROM memories ORDER BY created_at DESC LIMIT 1')
+            row = cursor.fetchone()
+            if row is not None and row[0] == 'text':
+                cursor.execute('''
+                    UPDATE memories
+                    SET created_at = CAST(strftime('%s', created_at) AS INTEGER),
+                        updated_at = CAST(strftime('%s', updated_at) AS INTEGER)
+                    WHERE typeof(created_at) = 'text'
+                ''')
+            
+            self._initialize_fts_table(cursor)
+            self._initialize_vec_table(cursor)
+    
+    def _resolve_embedding_dtype(self, cursor: sqlite3.Cursor, embedding_dtype: Any, 
+                                 new_embedding_dtype: Any) -> np.dtype:
+        """Return the dtype the database stores embeddings in, recording it if it isn't yet."""
+        cursor.execute("SELECT value FROM storage_meta WHERE key = 'embedding_dtype'")
+        row = cursor.fetchone()
+        if row is not None:
+            stored = np.dtype(row[0])
+        else:
+            # Databases from before the dtype was recorded hold float32 embeddings
+            cursor.execute('SELECT 1 FROM memories WHERE embedding IS NOT NULL LIMIT 1')
+            if cursor.fetchone() is not None:
+                stored = np.dtype(np.float32)
+            elif embedding_dtype is not None:
+                stored = np.dtype(embedding_dtype)
+            else:
+                stored = np.dtype(new_embedding_dtype)
+            cursor.execute(
+                "INSERT INTO storage_meta (key, value) VALUES ('embedding_dtype', ?)", (stored.name,)
+            )
+        
+        if embedding_dtype is not None and np.dtype(embedding_dtype) != stored:
+            raise ValueError(
+                f"{self.db_path} stores {stored.name} embeddings, not {np.dtype(embedding_dtype).name}"
+            )
+        return stored
+    
+    def _resolve_embedding_dim(self, cursor: sqlite3.Cursor) -> Optional[int]:
+        """Return the dimension of the stored embeddings, or None before any is stored."""
+        cursor.execute("SELECT value FROM storage_meta WHERE key = 'embedding_dim'")
+        row = cursor.fetchone()
+        if row is not None:
+            return row[0]
+        
+        # Databases from before the dimension was recorded take it from their first embedding
+        cursor.execute('SELECT length(embedding) FROM memories WHERE embedding IS NOT NULL ORDER BY id LIMIT 1')
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        dim = row[0] // self.embedding_dtype.itemsize
+        cursor.execute("INSERT INTO storage_meta (key, value) VALUES ('embedding_dim', ?)", (dim,))
+        return dim
+    
+    def _check_embedding_dim(self, cursor: sqlite3.Cursor, embedding_bytes: bytes) -> None:
+        """
+        Record the dimension of the first stored embedding and reject any other.
+        
+        The caller holds the writer lock inside a transaction, which the
+        ValueError rolls back.
+        """
+        if self.embedding_dim is None:
+            # Another connection may have stored the first embedding since
+            self.embedding_dim = self._resolve_embedding_dim(cursor)
+        
+        dim = len(embedding_bytes) // self.embedding_dtype.itemsize
+        if self.embedding_dim is None:
+            cursor.execute("INSERT INTO storage_meta (key, value) VALUES ('embedding_dim', ?)", (dim,))
+            self.embedding_dim = dim
+        elif dim != self.embedding_dim:
+            raise ValueError(
+                f"{self.db_path} stores {self.embedding_dim}-dimensional embeddings, not {dim}-dimensional"
+            )
+    
+    def _check_stored_embedding(self, memory_id: int, blob: bytes, itemsize: int) -> None:
+        """Raise ValueError if a stored embedding blob doesn't hold embedding_dim values of itemsize bytes."""
+        if len(blob) != self.embedding_dim * itemsize:
+            raise ValueError(
+                f"Memory {memory_id} in {self.db_path} has a {len(blob)}-byte embedding, but "
+                f"{self.embedding_dim}-dimensional embeddings take {self.embedding_dim * itemsize} bytes"
+            )
+    
+    def _initialize_fts_table(self, cursor: sqlite3.Cursor) -> None:
+        """Create the FTS5 index over memory content and the triggers that keep it in sync."""
+        cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'memories_fts'")
+        row = cursor.fetchone()
+        exists = row is not None and 'porter' in row[0]
+        if row is not None and not exists:
+            # Recreate an index built before stemming; the triggers refer to it by name
+            cursor.execute('DROP TABLE memories_fts')
+        
+        # Porter stemming lets "running" match "runs"
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts 
+            USING fts5(content, content='memories', content_rowid='id', tokenize='porter unicode61')
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS memories_fts_insert AFTER INSERT ON memories BEGIN
+                INSERT INTO memories_fts (rowid, content) VALUES (new.id, new.content);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS memories_fts_delete AFTER DELETE ON memories BEGIN
+                INSERT INTO memories_fts (memories_fts, rowid, content) 
+                VALUES ('delete', old.id, old.content);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS memories_fts_update AFTER UPDATE OF content ON memories BEGIN
+                INSERT INTO memories_fts (memories_fts, rowid, content) 
+                VALUES ('delete', old.id, old.content);
+                INSERT INTO memories_fts (rowid, content) VALUES (new.id, new.content);
+            END
+        ''')
+        
+        # Index the content of a database created before the FTS table existed,
+        # or before it was stemmed
+        if not exists:
+            cursor.execute("INSERT INTO memories_fts (memories_fts) VALUES ('rebuild')")
+    
+    def _initialize_vec_table(self, cursor: sqlite3.Cursor) -> None:
+        """Find the sqlite-vec mirror of the embeddings, creating or rebuilding it if it is behind."""
+        if sqlite_vec is None:
+            return
+        
+        # The mirror records the write generation it reflects; writes made
+        # without sqlite-vec loaded leave it behind
+        generation = self._generation()
+        cursor.execute("SELECT value FROM storage_meta WHERE key = 'vec_generation'")
+        row = cursor.fetchone()
+        self._vec_dim = self._vec_table_dim(cursor)
+        if self._vec_dim is not None and row is not None and row[0] == generation:
+            return
+        
+        # Mirror the embeddings of a database created or written without
+        # sqlite-vec; an empty database gets the table with its first embedding
+        cursor.execute('DROP TABLE IF EXISTS memories_vec')
+        self._vec_dim = None
+        cursor.execute('SELECT id, embedding FROM memories WHERE embedding IS NOT NULL')
+        for memory_id, embedding_bytes in cursor.fetchall():
+            self._upsert_vector(cursor, memory_id, embedding_bytes)
+        cursor.execute(
+            "INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('vec_generation', ?)", (generation,)
+        )
+    
+    def _vec_table_dim(self, cursor: sqlite3.Cursor) -> Optional[int]:
+        """Return the dimension of the sqlite-vec mirror table, or None if it doesn't exist."""
+        cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'memories_vec'")
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return int(re.search(r'float\[(\d+)\]', row[0]).group(1))
+    
+    def _upsert_vector(self, cursor: sqlite3.Cursor, memory_id: int, embedding_bytes: bytes) -> None:
+        """Mirror a stored embedding into the sqlite-vec table, if sqlite-vec is installed."""
+        if sqlite_vec is None:
+            return
+        
+        vector = np.frombuffer(embedding_bytes, dtype=self.embedding_dtype).astype(np.float32)
+        if self._vec_dim is None:
+            cursor.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS memories_vec USING vec0(
+                    id INTEGER PRIMARY KEY,
+                    embedding float[{len(vector)}] distance_metric=cosine
+                )
+            ''')
+            self._vec_dim = len(vector)
+        
+        # vec0 tables don't support upserts
+        cursor.execute('DELETE FROM memories_vec WHERE id = ?', (memory_id,))
+        cursor.execute(
+            'INSERT INTO memories_vec (id, embedding) VALUES (?, ?)',
+            (memory_id, vector.tobytes())
+        )
+    
+    def get_ids_by_content(self, contents: List[str]) -> List[Optional[int]]:
+        """
+        Look up existing memories by content.
+        
+        Args:
+            contents: The contents to look up.
+            
+        Returns:
+            For each content, the ID of the memory holding the same content, or None.
+        """
+        if not contents:
+            return []
+        
+        digests = [content_hash(content) for content in contents]
+        with self._read() as conn:
+            cursor = conn.cursor()
+            placeholders = ', '.join('?' * len(digests))
+            cursor.execute(f'''
+                SELECT content_hash, id FROM memories
+                WHERE content_hash IN ({placeholders})
+            ''', digests)
+            ids_by_digest = dict(cursor.fetchall())
+        
+        return [ids_by_digest.get(digest) for digest in digests]
     
     def add_memory(self, content: str, embedding: Optional[np.ndarray] = None, 
                    metadata: Optional[Dict[str, Any]] = None) -> int:
@@ -46,28 +636,132 @@ class MemoryStorage:
             metadata: Optional metadata dictionary.
             
         Returns:
-            The ID of the newly created memory.
+            The ID of the newly created memory, or of the existing memory with
+            the same content.
         """
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        return self.add_memories([(content, embedding, metadata)])[0]
+    
+    def add_memories(self, items: List[Tuple[str, Optional[np.ndarray], Optional[Dict[str, Any]]]]) -> List[int]:
+        """
+        Add several memories in a single transaction.
+        
+        Args:
+            items: A list of (content, embedding, metadata) tuples; embedding and
+                metadata may be None.
             
-            # Convert embedding to bytes if provided
+        Returns:
+            The IDs of the newly created memories, in input order. Duplicated
+            content maps to the ID of the memory already holding it.
+        """
+        if not items:
+            return []
+        
+        # Encode every row before taking the write lock
+        rows = []
+        for content, embedding, metadata in items:
             embedding_bytes = None
             if embedding is not None:
-                embedding_bytes = embedding.tobytes()
+                embedding_bytes = self._embedding_bytes(embedding)
             
-            # Convert metadata to JSON string if provided
             metadata_json = None
             if metadata is not None:
-                metadata_json = json.dumps(metadata)
+                metadata_json = _json_dumps(metadata)
             
-            cursor.execute('''
-                INSERT INTO memories (content, embedding, metadata)
-                VALUES (?, ?, ?)
-            ''', (content, embedding_bytes, metadata_json))
+            rows.append((
+                content, content_hash(content), count_tokens(content), embedding_bytes,
+                *self._quantized_columns(embedding_bytes), metadata_json
+            ))
+        
+        return self._insert_rows(rows)
+    
+    def add_memories_array(self, contents: List[str], embeddings: np.ndarray, 
+                           metadatas: Optional[List[Optional[Dict[str, Any]]]] = None) -> List[int]:
+        """
+        Add several memories whose embeddings are the rows of one matrix.
+        
+        The matrix is normalized, encoded and quantized in one pass each, and
+        every row's blobs are zero-copy slices of the encoded buffers.
+        
+        Args:
+            contents: The text content of each memory.
+            embeddings: A (len(contents), D) matrix with one embedding per row.
+            metadatas: Optional metadata dictionary (or None) for each memory.
+            
+        Returns:
+            The IDs of the memories, in input order, as in add_memories.
+        """
+        if not contents:
+            return []
+        if metadatas is None:
+            metadatas = [None] * len(contents)
+        
+        matrix = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        quantized, scales = quantize_int8_rows(matrix)
+        
+        # Encode each column once and slice the rows out without copying
+        stored = matrix.astype(self.embedding_dtype)
+        embedding_buffer = memoryview(stored.tobytes())
+        quantized_buffer = memoryview(quantized.tobytes())
+        embedding_size = stored.shape[1] * stored.itemsize
+        quantized_size = quantized.shape[1]
+        
+        rows = []
+        for i, (content, metadata) in enumerate(zip(contents, metadatas)):
+            rows.append((
+                content, content_hash(content), count_tokens(content),
+                embedding_buffer[i * embedding_size:(i + 1) * embedding_size],
+                quantized_buffer[i * quantized_size:(i + 1) * quantized_size],
+                float(scales[i]),
+                _json_dumps(metadata) if metadata is not None else None
+            ))
+        
+        return self._insert_rows(rows)
+    
+    def _insert_rows(self, rows: List[Tuple[Any, ...]]) -> List[int]:
+        """Insert encoded memory rows in one transaction and return the ID for each."""
+        digests = [row[1] for row in rows]
+        
+        with self._write() as conn:
+            cursor = conn.cursor()
+            
+            for row in rows:
+                if row[3] is not None:
+                    self._check_embedding_dim(cursor, row[3])
+            
+            # IDs only grow, so rows above the current maximum are the new ones
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM memories')
+            last_id = cursor.fetchone()[0]
+            
+            # One statement for the whole batch; content that already exists is skipped
+            # Timestamps are set explicitly because older tables default to text
+            cursor.executemany(f'''
+                INSERT OR IGNORE INTO memories (
+                    content, content_hash, token_count, embedding, embedding_i8, embedding_scale, metadata,
+                    created_at, updated_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, {_NOW}, {_NOW})
+            ''', rows)
+            
+            # Resolve the ID holding each content, whether new or existing
+            unique_digests = list(dict.fromkeys(digests))
+            placeholders = ', '.join('?' * len(unique_digests))
+            cursor.execute(f'''
+                SELECT content_hash, id FROM memories
+                WHERE content_hash IN ({placeholders})
+            ''', unique_digests)
+            ids_by_digest = dict(cursor.fetchall())
             
-            conn.commit()
-            return cursor.lastrowid
+            # The first row of each new content is the one that was inserted
+            new_rows = {}
+            for row, digest in zip(rows, digests):
+                memory_id = ids_by_digest[digest]
+                if memory_id > last_id and row[3] is not None:
+                    new_rows.setdefault(memory_id, row)
+            for memory_id, row in new_rows.items():
+                self._upsert_vector(cursor, memory_id, row[3])
+                self._set_embedding_row(memory_id, *row[3:6])
+        
+        return [ids_by_digest[digest] for digest in digests]
     
     def get_memory(self, memory_id: int) -> Optional[Dict[str, Any]]:
         """
@@ -79,129 +773,416 @@ class MemoryStorage:
         Returns:
             A dictionary containing the memory data, or None if not found.
         """
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, content, embedding, created_at, updated_at, metadata
-                FROM memories
-                WHERE id = ?
-            ''', (memory_id,))
-            
-            row = cursor.fetchone()
+        with self._read() as conn:
+            row = conn.execute(self._sql_get_memory, (memory_id,)).fetchone()
             if row is None:
                 return None
             
-            # Convert embedding bytes back to numpy array
-            embedding = None
-            if row[2] is not None:
-                embedding = np.frombuffer(row[2], dtype=np.float32)
-            
-            # Parse metadata JSON
-            metadata = None
-            if row[5] is not None:
-                metadata = json.loads(row[5])
-            
-            return {
-                'id': row[0],
-                'content': row[1],
-                'embedding': embedding,
-                'created_at': row[3],
-                'updated_at': row[4],
-                'metadata': metadata
+            return self._row_to_memory(row)
+    
+    def get_memories_by_ids(self, memory_ids: List[int], 
+                            include_metadata: bool = True) -> List[Dict[str, Any]]:
+        """
+        Retrieve several memories by their IDs with a single query.
+        
+        Args:
+            memory_ids: The IDs of the memories to retrieve.
+            include_metadata: Whether to parse metadata; if False, 'metadata' is None.
+            
+        Returns:
+            A list of memory dictionaries in the order of memory_ids. IDs that
+            are not found are skipped.
+        """
+        if not memory_ids:
+            return []
+        
+        with self._read() as conn:
+            cursor = conn.execute(self._sql_get_memories_by_ids, (_json_dumps(list(memory_ids)),))
+            
+            row_to_memory = self._row_to_memory
+            memories_by_id = {
+                row['id']: row_to_memory(row, include_metadata) for row in cursor.fetchall()
             }
+            
+            return [memories_by_id[memory_id] for memory_id in memory_ids if memory_id in memories_by_id]
     
-    def find_similar_memories(self, query_embedding: np.ndarray, 
-                             limit: int = 5) -> List[Dict[str, Any]]:
+    def find_similar_memories(self, query_embedding: np.ndarray, limit: int = 5, 
+                             include_metadata: bool = True) -> List[Dict[str, Any]]:
         """
         Find memories similar to the given embedding using cosine similarity.
         
         Args:
             query_embedding: The embedding to compare against.
             limit: Maximum number of memories to return.
+            include_metadata: Whether to parse metadata; if False, 'metadata' is None.
             
         Returns:
             A list of memory dictionaries sorted by similarity.
         """
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, content, embedding, created_at, updated_at, metadata
-                FROM memories
-                WHERE embedding IS NOT NULL
-            ''')
+        if limit <= 0:
+            return []
+        
+        query_embedding = normalize(np.asarray(query_embedding, dtype=np.float32))
+        if self._vec_dim is not None and not (self.quantized_search or self.lsh_prefilter):
+            # sqlite-vec runs the whole top-k search inside SQLite
+            with self._read() as conn:
+                cursor = conn.execute('''
+                    SELECT id, distance
+                    FROM memories_vec
+                    WHERE embedding MATCH ? AND k = ?
+                    ORDER BY distance
+                ''', (query_embedding.tobytes(), limit))
+                similarity_by_id = {
+                    memory_id: 1.0 - distance for memory_id, distance in cursor.fetchall()
+                }
+        else:
+            similarity_by_id = self._score_embedding_matrix(query_embedding, limit)
+        
+        # Load only the selected memories
+        memories = self.get_memories_by_ids(list(similarity_by_id), include_metadata)
+        for memory in memories:
+            memory['similarity'] = similarity_by_id[memory['id']]
+        
+        return memories
+    
+    def _score_embedding_matrix(self, query_embedding: np.ndarray, limit: int) -> Dict[int, float]:
+        """Return the similarity of the top 'limit' stored embeddings, best first."""
+        # Holding the writer lock keeps writes from changing the rows mid-scan
+        with self._lock:
+            self._load_embedding_matrix()
+            count = self._emb_count
+            if not count:
+                return {}
+            
+            rows = slice(count)
+            candidates = LSH_CANDIDATES_PER_RESULT * limit
+            if self.lsh_prefilter and candidates < count:
+                # Only the rows whose signatures differ in the fewest bits are scored
+                query_signature = lsh_signatures(
+                    query_embedding[None, :], _lsh_projection(len(query_embedding))
+                )[0]
+                distances = hamming_distances(self._emb_signatures[:count], query_signature)
+                rows = np.argpartition(distances, candidates - 1)[:candidates]
+            matrix = self._emb_matrix[rows]
             
-            memories = []
-            for row in cursor.fetchall():
-                # Convert embedding bytes back to numpy array
-                memory_embedding = np.frombuffer(row[2], dtype=np.float32)
-                
-                # Calculate cosine similarity
-                similarity = np.dot(query_embedding, memory_embedding) / (
-                    np.linalg.norm(query_embedding) * np.linalg.norm(memory_embedding)
+            if self.quantized_search:
+                # Integer dot products rescaled by both per-vector scales approximate
+                # the cosine similarity of the unit-length originals
+                quantized_query, query_scale = quantize_int8(query_embedding)
+                similarities = (
+                    int8_dot_scores(matrix, quantized_query) * self._emb_scales[rows] * query_scale
                 )
-                
-                # Parse metadata JSON
-                metadata = None
-                if row[5] is not None:
-                    metadata = json.loads(row[5])
-                
-                memories.append({
-                    'id': row[0],
-                    'content': row[1],
-                    'embedding': memory_embedding,
-                    'similarity': similarity,
-                    'created_at': row[3],
-                    'updated_at': row[4],
-                    'metadata': metadata
-                })
-            
-            # Sort by similarity (descending) and return the top 'limit' memories
-            memories.sort(key=lambda x: x['similarity'], reverse=True)
-            return memories[:limit]
-    
-    def search_by_content(self, query: str, limit: int = 5) -> List[Dict[str, Any]]:
-        """
-        Search for memories containing the given query string.
+            else:
+                # Rows and query are unit-length, so cosine similarity is one pass over the matrix
+                similarities = cosine_scores(matrix, query_embedding)
+            
+            # Select the top 'limit' rows without sorting the whole array
+            if limit < len(similarities):
+                top_idx = np.argpartition(-similarities, limit - 1)[:limit]
+            else:
+                top_idx = np.arange(len(similarities))
+            top_idx = top_idx[np.argsort(-similarities[top_idx])]
+            
+            ids = self._emb_ids[rows]
+            return {int(ids[i]): float(similarities[i]) for i in top_idx}
+    
+    def _snapshot_paths(self) -> Dict[str, str]:
+        """Return the .npy files holding the saved embedding copy for the current search mode."""
+        kind = 'i8' if self.quantized_search else 'f32'
+        return {
+            name: f"{self.db_path}.emb-{kind}-{name}.npy"
+            for name in ('ids', 'matrix', 'scales', 'generation')
+        }
+    
+    def _save_embedding_snapshot(self) -> None:
+        """Write the embedding copy next to the database if it changed; the caller holds the writer lock."""
+        if (
+            not self._emb_loaded
+            or self.db_path == ":memory:"
+            or self._emb_generation == self._snapshot_generation
+            or self._emb_generation != self._generation()
+        ):
+            return
+        
+        count = self._emb_count
+        arrays = {
+            'ids': self._emb_ids[:count],
+            'matrix': self._emb_matrix[:count],
+            'scales': self._emb_scales[:count],
+            # Written last, so a partly written snapshot never matches
+            'generation': np.array([self._emb_generation], dtype=np.int64),
+        }
+        paths = self._snapshot_paths()
+        try:
+            with suppress(FileNotFoundError):
+                os.remove(paths['generation'])
+            for name, array in arrays.items():
+                # Replace the file rather than truncating one this session may have mapped
+                temp_path = f"{paths[name]}.tmp"
+                with open(temp_path, 'wb') as f:
+                    np.save(f, array)
+                os.replace(temp_path, paths[name])
+        except OSError:
+            # The snapshot only saves load time; the next session reads the database
+            pass
+    
+    def _load_embedding_snapshot(self) -> bool:
+        """
+        Memory-map the embedding copy saved by a previous session.
+        
+        The snapshot is only used if it was saved at the database's current
+        write generation, so any later write, by this or another process,
+        makes it stale.
+        
+        Returns:
+            True if the snapshot was loaded.
+        """
+        paths = self._snapshot_paths()
+        if self.db_path == ":memory:" or not all(os.path.exists(path) for path in paths.values()):
+            return False
+        
+        try:
+            # Copy-on-write maps read pages lazily and keep later writes in memory
+            ids, matrix, scales = (
+                np.load(paths[name], mmap_mode='c') for name in ('ids', 'matrix', 'scales')
+            )
+            generation = int(np.load(paths['generation'])[0])
+        except (OSError, ValueError, IndexError):
+            return False
+        
+        if generation != self._emb_generation or not len(ids) == len(matrix) == len(scales):
+            return False
+        
+        self._emb_ids, self._emb_matrix, self._emb_scales = ids, matrix, scales
+        self._snapshot_generation = generation
+        return True
+    
+    def _load_embedding_matrix(self) -> None:
+        """Load the embedding copy if it isn't loaded or is stale; the caller holds the writer lock."""
+        # Another process may have written since the copy was loaded
+        generation = self._generation()
+        if self._emb_loaded and self._emb_generation == generation:
+            return
+        
+        self._emb_loaded = False
+        self._emb_generation = generation
+        unnormalized_ids = []
+        if not self._load_embedding_snapshot():
+            if self.quantized_search:
+                self._load_quantized_matrix()
+            else:
+                unnormalized_ids = self._load_float_matrix()
+        self._emb_loaded = True
+        
+        self._emb_count = len(self._emb_ids)
+        self._emb_rows = {int(memory_id): row for row, memory_id in enumerate(self._emb_ids)}
+        
+        self._emb_signatures = np.zeros(self._emb_count, dtype=np.uint64)
+        if self.lsh_prefilter and self._emb_count:
+            self._emb_signatures = lsh_signatures(
+                self._emb_matrix, _lsh_projection(self._emb_matrix.shape[1])
+            )
+        
+        if unnormalized_ids:
+            # One-time migration: rewrite them with the normalized rows. Every
+            # row was checked to hold embedding_dim values, so none of these
+            # were decoded from a blob of another dimension or dtype
+            self.update_embeddings([
+                (memory_id, self._emb_matrix[self._emb_rows[memory_id]]) for memory_id in unnormalized_ids
+            ])
+    
+    @property
+    def embedding_generation(self) -> Optional[int]:
+        """The write generation the in-memory embedding copy reflects, or None before it is loaded."""
+        return self._emb_generation
+    
+    def get_embedding_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the in-memory copy of the stored embeddings, loading or refreshing it if needed.
+        
+        Returns:
+            The (N, D) matrix of unit-length embeddings (int8 with quantized_search)
+            and the N memory IDs of its rows. Both are views into buffers that
+            later writes modify, so use them before writing again.
+        """
+        with self._lock:
+            self._load_embedding_matrix()
+            count = self._emb_count
+            return self._emb_matrix[:count], self._emb_ids[:count]
+    
+    def _load_float_matrix(self) -> List[int]:
+        """
+        Load the stacked float32 embedding matrix.
+        
+        Returns:
+            The IDs of memories whose stored embedding isn't unit-length.
+        """
+        rows = self._conn.execute(
+            'SELECT id, embedding FROM memories WHERE embedding IS NOT NULL'
+        ).fetchall()
+        
+        self._emb_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self._emb_scales = np.zeros(len(rows), dtype=np.float32)
+        if not rows:
+            self._emb_matrix = np.zeros((0, 0), dtype=np.float32)
+            return []
+        
+        self._refresh_embedding_dim(rows[0][1], self.embedding_dtype.itemsize)
+        for memory_id, blob in rows:
+            self._check_stored_embedding(memory_id, blob, self.embedding_dtype.itemsize)
+        
+        # Upcast float16 first: the kernels are compiled for float32
+        matrix = np.stack(
+            [np.frombuffer(row[1], dtype=self.embedding_dtype) for row in rows]
+        ).astype(np.float32)
+        norms = np.linalg.norm(matrix, axis=1)
+        self._emb_matrix = normalize_rows(matrix)
+        
+        # Embeddings stored before they were normalized (the tolerance absorbs float16 rounding)
+        return self._emb_ids[(norms > 0) & (np.abs(norms - 1) > 1e-2)].tolist()
+    
+    def _load_quantized_matrix(self) -> None:
+        """Load the stacked int8 embedding matrix and its per-row scales."""
+        # Only rows written before the int8 columns existed need their float embedding
+        rows = self._conn.execute('''
+            SELECT id, embedding_i8, embedding_scale,
+                   CASE WHEN embedding_i8 IS NULL THEN embedding END
+            FROM memories
+            WHERE embedding IS NOT NULL
+        ''').fetchall()
+        
+        self._emb_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        if not rows:
+            self._emb_matrix = np.zeros((0, 0), dtype=np.int8)
+            self._emb_scales = np.zeros(0, dtype=np.float32)
+            return
+        
+        _, quantized, _, embedding_bytes = rows[0]
+        if quantized is None:
+            self._refresh_embedding_dim(embedding_bytes, self.embedding_dtype.itemsize)
+        else:
+            self._refresh_embedding_dim(quantized, 1)
+        
+        quantized_rows = []
+        scales = []
+        for memory_id, quantized, scale, embedding_bytes in rows:
+            if quantized is not None:
+                self._check_stored_embedding(memory_id, quantized, 1)
+            else:
+                self._check_stored_embedding(memory_id, embedding_bytes, self.embedding_dtype.itemsize)
+                vector = np.frombuffer(embedding_bytes, dtype=self.embedding_dtype).astype(np.float32)
+                vector = normalize(vector)
+                quantized, scale = quantize_int8(vector)
+                quantized = quantized.tobytes()
+            quantized_rows.append(np.frombuffer(quantized, dtype=np.int8))
+            scales.append(scale)
+        
+        self._emb_matrix = np.stack(quantized_rows)
+        self._emb_scales = np.array(scales, dtype=np.float32)
+    
+    def _refresh_embedding_dim(self, first_blob: bytes, itemsize: int) -> None:
+        """Read the recorded embedding dimension before checking loaded rows against it."""
+        row = self._conn.execute("SELECT value FROM storage_meta WHERE key = 'embedding_dim'").fetchone()
+        # Without one, the rows were stored by a version that didn't record it
+        self.embedding_dim = row[0] if row is not None else len(first_blob) // itemsize
+    
+    def _reserve_embedding_rows(self, rows: int, dim: int) -> None:
+        """Grow the embedding copy, doubling its capacity, until it fits `rows` rows."""
+        if self._emb_count and self._emb_matrix.shape[1] != dim:
+            raise ValueError(
+                f"Can't add a {dim}-dimensional embedding to {self._emb_matrix.shape[1]}-dimensional ones"
+            )
+        
+        capacity = len(self._emb_ids)
+        if rows <= capacity and self._emb_matrix.shape[1] == dim:
+            return
+        
+        capacity = max(capacity, INITIAL_EMBEDDING_CAPACITY)
+        while capacity < rows:
+            capacity *= 2
+        
+        count = self._emb_count
+        ids = np.zeros(capacity, dtype=np.int64)
+        matrix = np.zeros((capacity, dim), dtype=np.int8 if self.quantized_search else np.float32)
+        scales = np.zeros(capacity, dtype=np.float32)
+        signatures = np.zeros(capacity, dtype=np.uint64)
+        if count:
+            ids[:count] = self._emb_ids[:count]
+            matrix[:count] = self._emb_matrix[:count]
+            scales[:count] = self._emb_scales[:count]
+            signatures[:count] = self._emb_signatures[:count]
+        self._emb_ids, self._emb_matrix, self._emb_scales = ids, matrix, scales
+        self._emb_signatures = signatures
+    
+    def _set_embedding_row(self, memory_id: int, embedding_bytes: bytes, 
+                           quantized: Optional[bytes], scale: Optional[float]) -> None:
+        """Add or replace a memory's row in the embedding copy, if it is loaded."""
+        if not self._emb_loaded:
+            return
+        
+        if self.quantized_search:
+            vector = np.frombuffer(quantized, dtype=np.int8)
+        else:
+            vector = np.frombuffer(embedding_bytes, dtype=self.embedding_dtype)
+        
+        row = self._emb_rows.get(memory_id)
+        self._reserve_embedding_rows(self._emb_count + (row is None), len(vector))
+        if row is None:
+            row = self._emb_count
+            self._emb_ids[row] = memory_id
+            self._emb_rows[memory_id] = row
+            self._emb_count += 1
+        
+        self._emb_matrix[row] = vector
+        self._emb_scales[row] = scale or 0.0
+        if self.lsh_prefilter:
+            self._emb_signatures[row] = lsh_signatures(vector[None, :], _lsh_projection(len(vector)))[0]
+    
+    def _remove_embedding_row(self, memory_id: int) -> None:
+        """Remove a memory's row from the embedding copy by swapping the last row into its place."""
+        if not self._emb_loaded:
+            return
+        
+        row = self._emb_rows.pop(memory_id, None)
+        if row is None:
+            return
+        
+        last = self._emb_count - 1
+        if row != last:
+            moved_id = int(self._emb_ids[last])
+            self._emb_ids[row] = moved_id
+            self._emb_matrix[row] = self._emb_matrix[last]
+            self._emb_scales[row] = self._emb_scales[last]
+            self._emb_signatures[row] = self._emb_signatures[last]
+            self._emb_rows[moved_id] = row
+        self._emb_count = last
+    
+    def search_by_content(self, query: str, limit: int = 5, 
+                          include_metadata: bool = True) -> List[Dict[str, Any]]:
+        """
+        Search for memories containing the words of the given query.
+        
+        Uses the full-text index, so each query word matches words in the
+        content that start with it, after Porter stemming of both.
         
         Args:
-            query: The string to search for in memory content.
+            query: The words to search for in memory content.
             limit: Maximum number of memories to return.
+            include_metadata: Whether to parse metadata; if False, 'metadata' is None.
             
         Returns:
-            A list of memory dictionaries.
+            A list of memory dictionaries, best matches first.
         """
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, content, embedding, created_at, updated_at, metadata
-                FROM memories
-                WHERE content LIKE ?
-                ORDER BY created_at DESC
-                LIMIT ?
-            ''', (f'%{query}%', limit))
-            
-            memories = []
-            for row in cursor.fetchall():
-                # Convert embedding bytes back to numpy array
-                embedding = None
-                if row[2] is not None:
-                    embedding = np.frombuffer(row[2], dtype=np.float32)
-                
-                # Parse metadata JSON
-                metadata = None
-                if row[5] is not None:
-                    metadata = json.loads(row[5])
-                
-                memories.append({
-                    'id': row[0],
-                    'content': row[1],
-                    'embedding': embedding,
-                    'created_at': row[3],
-                    'updated_at': row[4],
-                    'metadata': metadata
-                })
-            
-            return memories
+        match = _fts_query(query)
+        if not match:
+            return []
+        
+        with self._read() as conn:
+            # Rank and limit in the full-text index, then load the matches in the same query
+            cursor = conn.execute(self._sql_search_by_content, (match, limit))
+            
+            row_to_memory = self._row_to_memory
+            return [row_to_memory(row, include_metadata) for row in cursor.fetchall()]
     
     def update_memory(self, memory_id: int, content: Optional[str] = None, 
                      embedding: Optional[np.ndarray] = None, 
@@ -217,15 +1198,15 @@ class MemoryStorage:
             
         Returns:
             True if the memory was updated, False if not found.
+            
+        Raises:
+            sqlite3.IntegrityError: If the new content duplicates another memory.
         """
-        with sqlite3.connect(self.db_path) as conn:
+        # The embedding copy is keyed by int, while SQLite would also match "1"
+        memory_id = int(memory_id)
+        with self._write() as conn:
             cursor = conn.cursor()
             
-            # Check if the memory exists
-            cursor.execute('SELECT id FROM memories WHERE id = ?', (memory_id,))
-            if cursor.fetchone() is None:
-                return False
-            
             # Build the update query based on provided parameters
             update_fields = []
             params = []
@@ -233,20 +1214,32 @@ class MemoryStorage:
             if content is not None:
                 update_fields.append("content = ?")
                 params.append(content)
+                update_fields.append("content_hash = ?")
+                params.append(content_hash(content))
+                update_fields.append("token_count = ?")
+                params.append(count_tokens(content))
             
             if embedding is not None:
+                embedding_bytes = self._embedding_bytes(embedding)
+                self._check_embedding_dim(cursor, embedding_bytes)
+                quantized_columns = self._quantized_columns(embedding_bytes)
                 update_fields.append("embedding = ?")
-                params.append(embedding.tobytes())
+                params.append(embedding_bytes)
+                update_fields.append("embedding_i8 = ?")
+                update_fields.append("embedding_scale = ?")
+                params.extend(quantized_columns)
             
             if metadata is not None:
                 update_fields.append("metadata = ?")
-                params.append(json.dumps(metadata))
+                params.append(_json_dumps(metadata))
             
             if not update_fields:
-                return True  # Nothing to update
+                # Nothing to update, so only report whether the memory exists
+                cursor.execute('SELECT 1 FROM memories WHERE id = ?', (memory_id,))
+                return cursor.fetchone() is not None
             
             # Add the updated_at timestamp
-            update_fields.append("updated_at = CURRENT_TIMESTAMP")
+            update_fields.append(f"updated_at = {_NOW}")
             
             # Add the memory_id to the params
             params.append(memory_id)
@@ -257,10 +1250,40 @@ class MemoryStorage:
                 SET {', '.join(update_fields)}
                 WHERE id = ?
             ''', params)
+            if not cursor.rowcount:
+                return False
             
-            conn.commit()
+            if embedding is not None:
+                self._upsert_vector(cursor, memory_id, embedding_bytes)
+                self._set_embedding_row(memory_id, embedding_bytes, *quantized_columns)
             return True
     
+    def update_embeddings(self, items: List[Tuple[int, np.ndarray]]) -> None:
+        """
+        Replace the embeddings of several memories in a single transaction.
+        
+        Unlike update_memory, this leaves updated_at untouched, so it can be used
+        for maintenance such as re-normalizing stored embeddings.
+        
+        Args:
+            items: A list of (memory_id, embedding) tuples.
+        """
+        with self._write() as conn:
+            cursor = conn.cursor()
+            for memory_id, embedding in items:
+                memory_id = int(memory_id)
+                embedding_bytes = self._embedding_bytes(embedding)
+                self._check_embedding_dim(cursor, embedding_bytes)
+                quantized_columns = self._quantized_columns(embedding_bytes)
+                cursor.execute(
+                    'UPDATE memories SET embedding = ?, embedding_i8 = ?, embedding_scale = ? WHERE id = ?',
+                    (embedding_bytes, *quantized_columns, memory_id)
+                )
+                # Skip IDs that don't exist rather than adding rows for them
+                if cursor.rowcount:
+                    self._upsert_vector(cursor, memory_id, embedding_bytes)
+                    self._set_embedding_row(memory_id, embedding_bytes, *quantized_columns)
+    
     def delete_memory(self, memory_id: int) -> bool:
         """
         Delete a memory by its ID.
@@ -271,46 +1294,51 @@ class MemoryStorage:
         Returns:
             True if the memory was deleted, False if not found.
         """
-        with sqlite3.connect(self.db_path) as conn:
+        # The embedding copy is keyed by int, while SQLite would also match "1"
+        memory_id = int(memory_id)
+        with self._write() as conn:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM memories WHERE id = ?', (memory_id,))
-            conn.commit()
-            return cursor.rowcount > 0
+            deleted = cursor.rowcount > 0
+            if deleted:
+                self._remove_embedding_row(memory_id)
+            
+            if sqlite_vec is not None and self._vec_dim is None:
+                # Another connection may have created the mirror since this one opened
+                self._vec_dim = self._vec_table_dim(cursor)
+            if self._vec_dim is not None:
+                cursor.execute('DELETE FROM memories_vec WHERE id = ?', (memory_id,))
+            return deleted
     
-    def get_all_memories(self) -> List[Dict[str, Any]]:
+    def get_all_contents(self) -> List[Dict[str, Any]]:
         """
-        Retrieve all memories from the database.
+        Retrieve the ID and content of every memory, without embeddings or metadata.
         
         Returns:
-            A list of all memory dictionaries.
+            A list of dictionaries with 'id' and 'content' keys, newest first.
         """
-        with sqlite3.connect(self.db_path) as conn:
+        with self._read() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT id, content, embedding, created_at, updated_at, metadata
+                SELECT id, content
                 FROM memories
-                ORDER BY created_at DESC
+                ORDER BY created_at DESC, id DESC
             ''')
             
-            memories = []
-            for row in cursor.fetchall():
-                # Convert embedding bytes back to numpy array
-                embedding = None
-                if row[2] is not None:
-                    embedding = np.frombuffer(row[2], dtype=np.float32)
-                
-                # Parse metadata JSON
-                metadata = None
-                if row[5] is not None:
-                    metadata = json.loads(row[5])
-                
-                memories.append({
-                    'id': row[0],
-                    'content': row[1],
-                    'embedding': embedding,
-                    'created_at': row[3],
-                    'updated_at': row[4],
-                    'metadata': metadata
-                })
-            
-            return memories
+            return [{'id': row[0], 'content': row[1]} for row in cursor.fetchall()]
+    
+    def get_all_memories(self, include_metadata: bool = True) -> List[Dict[str, Any]]:
+        """
+        Retrieve all memories from the database.
+        
+        Args:
+            include_metadata: Whether to parse metadata; if False, 'metadata' is None.
+            
+        Returns:
+            A list of all memory dictionaries.
+        """
+        with self._read() as conn:
+            cursor = conn.execute(self._sql_get_all_memories)
+            
+            row_to_memory = self._row_to_memory
+            return [row_to_memory(row, include_metadata) for row in cursor.fetchall()]
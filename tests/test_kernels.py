@@ -0,0 +1,39 @@
+import unittest
+from unittest.mock import patch
+import numpy as np
+
+from src import kernels
+
+class TestKernels(unittest.TestCase):
+    @patch('src.kernels.os.cpu_count', return_value=4)
+    @patch('src.kernels.PARALLEL_SCORE_ROWS', 2)
+    def test_blocked_matmul(self, _):
+        rng = np.random.default_rng(0)
+        matrix = rng.standard_normal((10, 3)).astype(np.float32)
+        query = rng.standard_normal(3).astype(np.float32)
+        np.testing.assert_allclose(kernels._blocked_matmul(matrix, query), matrix @ query, rtol=1e-6)
+    
+    @patch('src.kernels.INT8_SCORE_BLOCK_ROWS', 4)
+    def test_int8_dot_scores_numpy(self):
+        # Ten rows span two full blocks and a partial one
+        rng = np.random.default_rng(0)
+        matrix = rng.integers(-127, 128, (10, 3)).astype(np.int8)
+        query = rng.integers(-127, 128, 3).astype(np.int8)
+        np.testing.assert_array_equal(
+            kernels._int8_dot_scores_numpy(matrix, query), matrix.astype(np.int32) @ query.astype(np.int32)
+        )
+        self.assertEqual(len(kernels._int8_dot_scores_numpy(matrix[:0], query)), 0)
+        
+        # Large matrices are split into one row range per core
+        with patch('src.kernels.os.cpu_count', return_value=3), patch('src.kernels.PARALLEL_SCORE_ROWS', 2):
+            np.testing.assert_array_equal(
+                kernels._int8_dot_scores_numpy(matrix, query), matrix.astype(np.int32) @ query.astype(np.int32)
+            )
+    
+    def test_hamming_distances(self):
+        signatures = np.random.default_rng(0).integers(0, 2**63, 10, dtype=np.uint64)
+        expected = [bin(int(signature) ^ int(signatures[3])).count('1') for signature in signatures]
+        np.testing.assert_array_equal(kernels.hamming_distances(signatures, signatures[3]), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
 import unittest
+import asyncio
 import os
+import glob
+import sqlite3
 import tempfile
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock
 import numpy as np
 
 from src.memory_system import MemorySystem
+from src.storage import MemoryStorage
 
 class TestMemorySystem(unittest.TestCase):
     def setUp(self):
@@ -20,8 +24,11 @@ class TestMemorySystem(unittest.TestCase):
             self.memory_system = MemorySystem(api_key=self.api_key, db_path=self.db_path)
     
     def tearDown(self):
-        # Remove the temporary database file
-        os.unlink(self.db_path)
+        self.memory_system.close()
+        
+        # Remove the temporary database file, its WAL files and any persisted index
+        for path in glob.glob(f"{self.db_path}*"):
+            os.unlink(path)
     
     @patch('src.memory_system.OpenAIClient.get_embedding')
     def test_add_memory(self, mock_get_embedding):
@@ -45,6 +52,46 @@ class TestMemorySystem(unittest.TestCase):
         self.assertEqual(memory['metadata']['category'], "test")
         self.assertEqual(memory['metadata']['importance'], 5)
     
+    @patch('src.memory_system.OpenAIClient.get_embeddings')
+    def test_add_memories_bulk(self, mock_get_embeddings):
+        # Mock the batched embedding response
+        mock_get_embeddings.return_value = [[0.1] * 1536, [0.2] * 1536]
+        
+        # Add two memories at once
+        memory_ids = self.memory_system.add_memories_bulk([
+            {"content": "Memory 1", "metadata": {"category": "test"}},
+            {"content": "Memory 2"}
+        ])
+        
+        # Check that both memories were added with a single embedding request
+        self.assertEqual(len(memory_ids), 2)
+        self.assertEqual(mock_get_embeddings.call_count, 1)
+        self.assertEqual(self.memory_system.get_memory(memory_ids[0])['metadata']['category'], "test")
+        self.assertEqual(self.memory_system.get_memory(memory_ids[1])['content'], "Memory 2")
+    
+    @patch('src.memory_system.OpenAIClient.get_embeddings')
+    @patch('src.memory_system.OpenAIClient.get_embedding')
+    def test_duplicate_memories(self, mock_get_embedding, mock_get_embeddings):
+        # Mock the embedding responses
+        mock_get_embedding.return_value = [0.1] * 1536
+        mock_get_embeddings.return_value = [[0.2] * 1536]
+        
+        # Re-adding the same content returns the existing memory without embedding it
+        memory_id = self.memory_system.add_memory("I like tea")
+        self.assertEqual(self.memory_system.add_memory("  I LIKE TEA "), memory_id)
+        self.assertEqual(mock_get_embedding.call_count, 1)
+        
+        # Duplicates in a batch are only embedded and stored once
+        memory_ids = self.memory_system.add_memories_bulk([
+            {"content": "I like tea"},
+            {"content": "I like coffee"},
+            {"content": "I like coffee"}
+        ])
+        self.assertEqual(memory_ids[0], memory_id)
+        self.assertEqual(memory_ids[1], memory_ids[2])
+        self.assertEqual(mock_get_embeddings.call_args.args[0], ["I like coffee"])
+        self.assertEqual(len(self.memory_system.get_all_memories()), 2)
+    
     def test_delete_memory(self):
         # Add a memory
         with patch('src.memory_system.OpenAIClient.get_embedding') as mock_get_embedding:
@@ -97,11 +144,172 @@ class TestMemorySystem(unittest.TestCase):
         for memory in relevant_memories:
             self.assertIn('similarity', memory)
     
+    @patch('src.memory_system.OpenAIClient.get_embedding')
+    def test_get_relevant_memories_ranking(self, mock_get_embedding):
+        # Add memories with distinct embeddings
+        mock_get_embedding.return_value = np.array([1.0, 0.0, 0.0])
+        memory_id1 = self.memory_system.add_memory("Memory 1")
+        mock_get_embedding.return_value = np.array([0.0, 1.0, 0.0])
+        memory_id2 = self.memory_system.add_memory("Memory 2")
+        mock_get_embedding.return_value = np.array([0.7, 0.7, 0.0])
+        memory_id3 = self.memory_system.add_memory("Memory 3")
+        
+        # Query closest to the first memory
+        mock_get_embedding.return_value = np.array([0.9, 0.1, 0.0])
+        relevant_memories = self.memory_system.get_relevant_memories("query", limit=2)
+        self.assertEqual([m['id'] for m in relevant_memories], [memory_id1, memory_id3])
+        self.assertGreater(relevant_memories[0]['similarity'], relevant_memories[1]['similarity'])
+        
+        # Deleted memories are no longer returned
+        self.memory_system.delete_memory(memory_id1)
+        relevant_memories = self.memory_system.get_relevant_memories("query", limit=5)
+        self.assertEqual([m['id'] for m in relevant_memories], [memory_id3, memory_id2])
+    
+    def test_open_baseline_database(self):
+        # A new database stores float16 embeddings
+        self.assertEqual(self.memory_system.storage.embedding_dtype, np.float16)
+        self.memory_system.close()
+        for path in glob.glob(f"{self.db_path}*"):
+            os.unlink(path)
+        
+        # A database written before the dtype was recorded holds float32 embeddings
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            CREATE TABLE memories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                content TEXT NOT NULL,
+                embedding BLOB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                metadata TEXT
+            )
+        ''')
+        conn.execute(
+            "INSERT INTO memories (content, embedding) VALUES (?, ?)",
+            ("Old memory", np.array([0.6, 0.8], dtype=np.float32).tobytes())
+        )
+        conn.commit()
+        conn.close()
+        
+        with patch.dict(os.environ, {"OPENAI_API_KEY": self.api_key}):
+            self.memory_system = MemorySystem(api_key=self.api_key, db_path=self.db_path)
+        self.assertEqual(self.memory_system.storage.embedding_dtype, np.float32)
+        np.testing.assert_allclose(self.memory_system.get_memory(1)['embedding'], [0.6, 0.8], rtol=1e-6)
+    
+    @patch('src.memory_system.OpenAIClient.get_embedding')
+    def test_embeddings_are_normalized(self, mock_get_embedding):
+        # New memories are stored with unit-length embeddings
+        mock_get_embedding.return_value = [3.0, 4.0]
+        memory_id = self.memory_system.add_memory("Test memory")
+        memory = self.memory_system.get_memory(memory_id)
+        np.testing.assert_allclose(memory['embedding'], [0.6, 0.8], rtol=1e-3)
+        
+        # Embeddings stored before normalization are rewritten on open
+        memory_id = self.memory_system.storage.add_memory("Old memory", embedding=np.array([0.0, 2.0]))
+        with patch.dict(os.environ, {"OPENAI_API_KEY": self.api_key}):
+            memory_system = MemorySystem(api_key=self.api_key, db_path=self.db_path)
+        memory = memory_system.get_memory(memory_id)
+        np.testing.assert_allclose(memory['embedding'], [0.0, 1.0], rtol=1e-3)
+        memory_system.close()
+    
+    @patch('src.storage.INITIAL_EMBEDDING_CAPACITY', 2)
+    @patch('src.memory_system.OpenAIClient.get_embedding')
+    def test_embedding_matrix_growth(self, mock_get_embedding):
+        # Adding past the initial capacity doubles the buffer and keeps every row
+        memory_ids = []
+        for i in range(5):
+            mock_get_embedding.return_value = np.eye(5)[i]
+            memory_ids.append(self.memory_system.add_memory(f"Memory {i}"))
+        self.assertEqual(len(self.memory_system.storage._emb_ids), 8)
+        self.assertEqual(self.memory_system.storage.get_embedding_matrix()[0].shape, (5, 5))
+        
+        # Deleting swaps the last row into place without shrinking the buffer
+        self.memory_system.delete_memory(memory_ids[1])
+        self.assertEqual(self.memory_system.storage.get_embedding_matrix()[0].shape, (4, 5))
+        mock_get_embedding.return_value = np.eye(5)[4]
+        relevant_memories = self.memory_system.get_relevant_memories("query", limit=1)
+        self.assertEqual(relevant_memories[0]['id'], memory_ids[4])
+    
+    @patch('src.retriever.faiss')
+    @patch('src.memory_system.OpenAIClient.get_embedding')
+    def test_faiss_index_saved_on_close(self, mock_get_embedding, mock_faiss):
+        mock_get_embedding.return_value = np.array([1.0, 0.0])
+        retriever = self.memory_system.retriever
+        retriever.index = MagicMock()
+        
+        # Closing writes an index changed by adds and removes, and only then
+        self.memory_system.add_memory("Indexed memory")
+        self.memory_system.close()
+        mock_faiss.write_index.assert_called_once_with(retriever.index, f"{self.db_path}.faiss")
+        retriever.save_index()
+        mock_faiss.write_index.assert_called_once()
+        
+        # The next session reuses the index saved at the current generation
+        open(f"{self.db_path}.faiss", 'wb').close()
+        with patch.dict(os.environ, {"OPENAI_API_KEY": self.api_key}):
+            self.memory_system = MemorySystem(api_key=self.api_key, db_path=self.db_path)
+        self.memory_system.retriever.build_index(*self.memory_system._embedding_matrix())
+        mock_faiss.read_index.assert_called_once()
+        
+        # but not once a write it didn't follow has moved the generation on
+        memory_id = self.memory_system.get_all_memories()[0]['id']
+        self.memory_system.storage.update_memory(memory_id, embedding=np.array([0.0, 1.0]))
+        self.memory_system.retriever.build_index(*self.memory_system._embedding_matrix())
+        mock_faiss.read_index.assert_called_once()
+        self.memory_system.retriever.index = None
+    
+    @patch('src.memory_system.OpenAIClient.get_embedding')
+    def test_search_sees_other_writers(self, mock_get_embedding):
+        # Memories written through another connection are searchable without reopening
+        self.memory_system.storage.get_embedding_matrix()
+        other = MemoryStorage(self.db_path)
+        memory_id = other.add_memory("Written elsewhere", embedding=np.array([0.0, 1.0]))
+        other.close()
+        mock_get_embedding.return_value = np.array([0.0, 1.0])
+        relevant_memories = self.memory_system.get_relevant_memories("query", limit=1)
+        self.assertEqual(relevant_memories[0]['id'], memory_id)
+    
+    @patch('src.memory_system.OpenAIClient.get_embeddings')
+    @patch('src.memory_system.OpenAIClient.get_embedding')
+    def test_get_relevant_memories_batched(self, mock_get_embedding, mock_get_embeddings):
+        # Add memories with distinct embeddings
+        mock_get_embedding.return_value = np.array([1.0, 0.0, 0.0])
+        memory_id1 = self.memory_system.add_memory("Memory 1")
+        mock_get_embedding.return_value = np.array([0.0, 1.0, 0.0])
+        memory_id2 = self.memory_system.add_memory("Memory 2")
+        mock_get_embedding.return_value = np.array([0.0, 0.0, 1.0])
+        memory_id3 = self.memory_system.add_memory("Memory 3")
+        
+        # Each query gets its own ranking from a single embedding request
+        mock_get_embeddings.return_value = np.array([[0.9, 0.1, 0.0], [0.0, 0.2, 0.8]])
+        results = self.memory_system.get_relevant_memories_batched(["query 1", "query 2"], limit=2)
+        self.assertEqual(mock_get_embeddings.call_count, 1)
+        self.assertEqual([m['id'] for m in results[0]], [memory_id1, memory_id2])
+        self.assertEqual([m['id'] for m in results[1]], [memory_id3, memory_id2])
+        self.assertGreater(results[1][0]['similarity'], results[1][1]['similarity'])
+    
+    def test_format_memories_for_context_budget(self):
+        memories = [
+            {'content': "User likes hiking", 'token_count': 4},
+            {'content': "User has a dog named Max", 'token_count': 6},
+            {'content': "User works as a nurse", 'token_count': 5},
+        ]
+        
+        # Memories are packed in rank order until the budget runs out
+        context = self.memory_system.retriever.format_memories_for_context(memories, token_budget=10)
+        self.assertEqual(context, "Relevant memories:\n- User likes hiking\n- User has a dog named Max")
+        
+        context = self.memory_system.retriever.format_memories_for_context(memories, token_budget=3)
+        self.assertEqual(context, "No relevant memories found.")
+    
     @patch('src.memory_system.OpenAIClient.extract_memories')
+    @patch('src.memory_system.OpenAIClient.get_embeddings')
     @patch('src.memory_system.OpenAIClient.get_embedding')
-    def test_process_conversation(self, mock_get_embedding, mock_extract_memories):
-        # Mock the embedding response
+    def test_process_conversation(self, mock_get_embedding, mock_get_embeddings, 
+                                  mock_extract_memories):
+        # Mock the embedding responses
         mock_get_embedding.return_value = [0.1] * 1536
+        mock_get_embeddings.return_value = [[0.1] * 1536]
         
         # Mock the memory extraction
         mock_extract_memories.return_value = [
@@ -128,15 +336,84 @@ class TestMemorySystem(unittest.TestCase):
         self.assertEqual(len(result['new_memories']), 1)
         self.assertEqual(result['new_memories'][0]['content'], "Test memory")
     
+    @patch('src.openai_client.openai.Embedding.create')
+    @patch('src.openai_client.openai.Embedding.acreate', new_callable=AsyncMock)
+    @patch('src.memory_system.OpenAIClient.aidentify_memories_to_delete', new_callable=AsyncMock)
+    @patch('src.memory_system.OpenAIClient.aextract_memories', new_callable=AsyncMock)
+    @patch('src.memory_system.OpenAIClient.get_embedding')
+    def test_aprocess_conversation(self, mock_get_embedding, mock_aextract_memories, 
+                                   mock_aidentify_memories_to_delete, 
+                                   mock_embedding_acreate, mock_embedding_create):
+        mock_get_embedding.return_value = [0.0, 1.0]
+        old_memory_id = self.memory_system.add_memory("User uses Magnet")
+        
+        mock_aextract_memories.return_value = [
+            {"content": "User uses Rectangle", "importance": 8, "category": "preference"}
+        ]
+        # Model output may give IDs as strings, or not as IDs at all
+        mock_aidentify_memories_to_delete.return_value = [str(old_memory_id), "Magnet"]
+        mock_embedding_acreate.side_effect = lambda model, input: {
+            'data': [{'index': i, 'embedding': [1.0, 0.0]} for i in range(len(input))]
+        }
+        
+        conversation = [
+            {"role": "user", "content": "I don't use Magnet anymore, I use Rectangle."}
+        ]
+        result = asyncio.run(self.memory_system.aprocess_conversation(conversation))
+        
+        # Every embedding came from the async client
+        mock_embedding_create.assert_not_called()
+        self.assertEqual([m['content'] for m in result['new_memories']], ["User uses Rectangle"])
+        self.assertEqual(result['deleted_memories'], [old_memory_id])
+        self.assertEqual(result['relevant_memories'][0]['content'], "User uses Rectangle")
+        self.assertNotIn(old_memory_id, self.memory_system.storage.get_embedding_matrix()[1])
+    
+    @patch('src.memory_system.OpenAIClient.identify_memories_to_delete')
+    @patch('src.memory_system.OpenAIClient.extract_memories')
+    def test_process_conversation_without_signal(self, mock_extract_memories, 
+                                                 mock_identify_memories_to_delete):
+        # Small talk never reaches the extraction or deletion calls
+        conversation = [
+            {"role": "user", "content": "Hello, thanks!"}
+        ]
+        result = self.memory_system.process_conversation(conversation)
+        
+        mock_extract_memories.assert_not_called()
+        mock_identify_memories_to_delete.assert_not_called()
+        self.assertEqual(result['new_memories'], [])
+        self.assertEqual(result['deleted_memories'], [])
+    
+    @patch('src.memory_system.OpenAIClient.get_embedding')
+    @patch('src.memory_system.OpenAIClient.identify_memories_to_delete')
+    @patch('src.memory_system.OpenAIClient.extract_memories')
+    def test_process_conversation_curly_apostrophes(self, mock_extract_memories, 
+                                                    mock_identify_memories_to_delete, 
+                                                    mock_get_embedding):
+        mock_extract_memories.return_value = []
+        mock_identify_memories_to_delete.return_value = []
+        mock_get_embedding.return_value = [0.1] * 1536
+        
+        # Curly apostrophes, as phone keyboards type them, still reach the LLM calls
+        self.memory_system.process_conversation([{"role": "user", "content": "I\u2019m allergic to peanuts"}])
+        mock_extract_memories.assert_called_once()
+        
+        self.memory_system.process_conversation([{"role": "user", "content": "I don\u2019t drink coffee"}])
+        mock_identify_memories_to_delete.assert_called_once()
+    
+    @patch('src.memory_system.OpenAIClient.analyze_turn')
     @patch('src.memory_system.OpenAIClient.chat_completion')
     @patch('src.memory_system.OpenAIClient.get_embedding')
-    def test_chat_with_memory(self, mock_get_embedding, mock_chat_completion):
+    def test_chat_with_memory(self, mock_get_embedding, mock_chat_completion, 
+                              mock_analyze_turn):
         # Mock the embedding response
         mock_get_embedding.return_value = [0.1] * 1536
         
         # Mock the chat completion
         mock_chat_completion.return_value = "You like test things."
         
+        # Mock the turn analysis
+        mock_analyze_turn.return_value = {'new_memories': [], 'delete_ids': []}
+        
         # Add a memory
         self.memory_system.add_memory("I like test things")
         
@@ -157,6 +434,63 @@ class TestMemorySystem(unittest.TestCase):
         
         # Check that relevant memories were found
         self.assertGreater(len(result['relevant_memories']), 0)
+    
+    @patch('src.memory_system.OpenAIClient.get_embeddings')
+    @patch('src.memory_system.OpenAIClient.analyze_turn')
+    @patch('src.memory_system.OpenAIClient.chat_completion_stream')
+    @patch('src.memory_system.OpenAIClient.get_embedding')
+    def test_chat_with_memory_stream(self, mock_get_embedding, mock_chat_completion_stream, 
+                                     mock_analyze_turn, mock_get_embeddings):
+        # Mock the embedding responses
+        mock_get_embedding.return_value = [0.1] * 1536
+        mock_get_embeddings.return_value = [[0.1] * 1536]
+        
+        # Mock the streamed chat completion
+        mock_chat_completion_stream.return_value = iter(["You like ", "test things."])
+        
+        # Mock the turn analysis
+        mock_analyze_turn.return_value = {
+            'new_memories': [{"content": "I like tea", "importance": 8}],
+            'delete_ids': []
+        }
+        
+        # Chat with memory
+        conversation = [
+            {"role": "user", "content": "I like tea. What do I like?"}
+        ]
+        result = self.memory_system.chat_with_memory(conversation, stream=True)
+        
+        # The response arrives in pieces
+        self.assertEqual(list(result['response_stream']), ["You like ", "test things."])
+        
+        # The full response and new memories are available once the stream is consumed
+        self.assertEqual(result['response'], "You like test things.")
+        self.assertEqual(len(result['new_memories']), 1)
+        self.assertEqual(result['new_memories'][0]['content'], "I like tea")
+    
+    @patch('src.memory_system.OpenAIClient.analyze_turn')
+    @patch('src.memory_system.OpenAIClient.chat_completion_stream')
+    @patch('src.memory_system.OpenAIClient.chat_completion')
+    @patch('src.memory_system.OpenAIClient.get_embedding')
+    def test_chat_with_memory_analysis_failure(self, mock_get_embedding, mock_chat_completion, 
+                                               mock_chat_completion_stream, mock_analyze_turn):
+        mock_get_embedding.return_value = [0.1] * 1536
+        mock_chat_completion.return_value = "Noted."
+        mock_chat_completion_stream.return_value = iter(["Noted."])
+        mock_analyze_turn.side_effect = RuntimeError("analysis failed")
+        conversation = [{"role": "user", "content": "I like tea."}]
+        
+        # The reply is returned even though the analysis raised
+        with self.assertLogs('src.memory_system', level='ERROR'):
+            result = self.memory_system.chat_with_memory(conversation)
+        self.assertEqual(result['response'], "Noted.")
+        self.assertEqual(result['new_memories'], [])
+        
+        with self.assertLogs('src.memory_system', level='ERROR'):
+            result = self.memory_system.chat_with_memory(conversation, stream=True)
+            self.assertEqual(list(result['response_stream']), ["Noted."])
+        self.assertEqual(result['response'], "Noted.")
+        self.assertEqual(result['deleted_memories'], [])
 
 if __name__ == '__main__':
     unittest.main()
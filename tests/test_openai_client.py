@@ -0,0 +1,104 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import numpy as np
+
+from src.openai_client import OpenAIClient
+
+def _embedding_response(texts):
+    # Return the items out of order to check that the client sorts by index
+    data = [{'index': i, 'embedding': [float(len(text)), float(i)]} for i, text in enumerate(texts)]
+    return {'data': list(reversed(data))}
+
+class TestOpenAIClient(unittest.TestCase):
+    def setUp(self):
+        self.client = OpenAIClient("test_api_key", embedding_cache_size=2)
+    
+    @patch('src.openai_client.openai.Embedding.create')
+    def test_get_embeddings(self, mock_create):
+        mock_create.side_effect = lambda model, input: _embedding_response(input)
+        
+        # Embed several texts with a single request
+        embeddings = self.client.get_embeddings(["a", "bb", "ccc"])
+        self.assertEqual(mock_create.call_count, 1)
+        np.testing.assert_array_equal(embeddings[:, 0], [1.0, 2.0, 3.0])
+    
+    @patch('src.openai_client.openai.Embedding.create')
+    def test_embedding_cache(self, mock_create):
+        mock_create.side_effect = lambda model, input: _embedding_response(input)
+        
+        # Repeated texts are only sent once
+        first = self.client.get_embedding("hello")
+        second = self.client.get_embedding("hello")
+        self.assertEqual(mock_create.call_count, 1)
+        np.testing.assert_array_equal(first, second)
+        
+        # Only texts missing from the cache are requested
+        self.client.get_embeddings(["hello", "world"])
+        self.assertEqual(mock_create.call_count, 2)
+        self.assertEqual(mock_create.call_args.kwargs['input'], ["world"])
+        
+        # The least recently used entry is evicted once the cache is full
+        self.client.get_embedding("again")
+        self.client.get_embedding("hello")
+        self.assertEqual(mock_create.call_count, 4)
+    
+    @patch('src.openai_client.openai.ChatCompletion.create')
+    def test_analyze_turn(self, mock_create):
+        mock_create.return_value = MagicMock()
+        mock_create.return_value.choices[0].message = {
+            'content': '{"new_memories": [{"content": "I like tea", "importance": 7}], "delete_ids": [3]}'
+        }
+        
+        # A single call returns both new memories and deletions
+        analysis = self.client.analyze_turn(
+            [{"role": "user", "content": "I like tea and no longer drink coffee."}],
+            [{"id": 3, "content": "I drink coffee"}]
+        )
+        self.assertEqual(mock_create.call_count, 1)
+        self.assertEqual(mock_create.call_args.kwargs['response_format'], {"type": "json_object"})
+        self.assertEqual(analysis['new_memories'][0]['content'], "I like tea")
+        self.assertEqual(analysis['delete_ids'], [3])
+    
+    @patch('src.openai_client.openai.ChatCompletion.create')
+    def test_analyze_turn_chunks(self, mock_create):
+        mock_create.return_value = MagicMock()
+        mock_create.return_value.choices[0].message = {'content': '{"new_memories": [], "delete_ids": [1]}'}
+        conversation = [{"role": "user", "content": "I don't use Magnet anymore."}]
+        
+        # Only memories sharing a keyword are sent, one analysis and one deletion request
+        memories = [{"id": i, "content": f"I use Magnet {i}"} for i in range(1, 4)]
+        memories.append({"id": 4, "content": "I live in Paris"})
+        analysis = self.client.analyze_turn(conversation, memories, max_memories_per_chunk=2)
+        self.assertEqual(mock_create.call_count, 2)
+        prompts = [call.kwargs['messages'][1]['content'] for call in mock_create.call_args_list]
+        self.assertFalse(any("Paris" in prompt for prompt in prompts))
+        self.assertEqual(analysis['delete_ids'], [1])
+    
+    @patch('src.openai_client.openai.ChatCompletion.create')
+    def test_identify_memories_to_delete_chunks(self, mock_create):
+        mock_create.return_value = MagicMock()
+        mock_create.return_value.choices[0].message = {'content': '{"delete_ids": [1]}'}
+        conversation = [{"role": "user", "content": "I don't use Magnet anymore."}]
+        
+        # Memories that don't fit one prompt are split into chunks and merged
+        memories = [{"id": i, "content": f"I use Magnet {i}"} for i in range(1, 6)]
+        memory_ids = self.client.identify_memories_to_delete(
+            conversation, memories, max_memories_per_chunk=2
+        )
+        self.assertEqual(mock_create.call_count, 3)
+        self.assertEqual(memory_ids, [1])
+        
+        # Memories without a shared keyword are not sent at all
+        mock_create.reset_mock()
+        memories = [
+            {"id": 1, "content": "I use Magnet"},
+            {"id": 2, "content": "I live in Paris"},
+            {"id": 3, "content": "I enjoy hiking"}
+        ]
+        self.client.identify_memories_to_delete(conversation, memories, max_memories_per_chunk=2)
+        self.assertEqual(mock_create.call_count, 1)
+        self.assertIn("I use Magnet", mock_create.call_args.kwargs['messages'][1]['content'])
+        self.assertNotIn("Paris", mock_create.call_args.kwargs['messages'][1]['content'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
 import unittest
 import os
+import glob
+import sqlite3
 import tempfile
+import threading
+from unittest.mock import patch
 import numpy as np
-from src.storage import MemoryStorage
+from src.storage import MemoryStorage, count_tokens, sqlite_vec
 
 class TestMemoryStorage(unittest.TestCase):
     def setUp(self):
@@ -14,8 +18,11 @@ class TestMemoryStorage(unittest.TestCase):
         self.storage = MemoryStorage(self.db_path)
     
     def tearDown(self):
-        # Remove the temporary database file
-        os.unlink(self.db_path)
+        self.storage.close()
+        
+        # Remove the temporary database file, its WAL files and any embedding snapshot
+        for path in glob.glob(f"{self.db_path}*"):
+            os.unlink(path)
     
     def test_add_and_get_memory(self):
         # Add a memory
@@ -33,8 +40,72 @@ class TestMemoryStorage(unittest.TestCase):
         self.assertIsNotNone(memory)
         self.assertEqual(memory['content'], "Test memory")
         self.assertEqual(memory['metadata']['category'], "test")
+        self.assertIsInstance(memory['created_at'], int)
         self.assertEqual(memory['metadata']['importance'], 5)
     
+    def test_text_timestamps_converted(self):
+        self.storage.close()
+        
+        # A database from before timestamps were stored as Unix times
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('DROP TABLE memories')
+        conn.execute('''
+            CREATE TABLE memories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                content TEXT NOT NULL,
+                embedding BLOB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                metadata TEXT
+            )
+        ''')
+        conn.execute("INSERT INTO memories (content, created_at) VALUES ('Old memory', '2024-01-01 00:00:00')")
+        conn.commit()
+        conn.close()
+        
+        self.storage = MemoryStorage(self.db_path)
+        memory_id = self.storage.add_memory("New memory")
+        memories = self.storage.get_all_memories()
+        self.assertEqual([m['content'] for m in memories], ["New memory", "Old memory"])
+        self.assertEqual(memories[1]['created_at'], 1704067200)
+        self.assertIsInstance(self.storage.get_memory(memory_id)['created_at'], int)
+    
+    def test_unhashed_duplicates_kept(self):
+        self.storage.close()
+        
+        # A database from before content was hashed, holding duplicates
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('DROP TABLE memories')
+        conn.execute('''
+            CREATE TABLE memories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                content TEXT NOT NULL,
+                embedding BLOB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                metadata TEXT
+            )
+        ''')
+        conn.executemany(
+            "INSERT INTO memories (content, metadata) VALUES (?, ?)",
+            [("I like tea", '{"a": 1}'), ("I like tea", '{"a": 2}'), ("i like TEA ", '{"a": 3}')]
+        )
+        conn.commit()
+        conn.close()
+        
+        # Every row survives, and new writes match the oldest copy
+        self.storage = MemoryStorage(self.db_path)
+        self.assertEqual(sorted(m['id'] for m in self.storage.get_all_contents()), [1, 2, 3])
+        self.assertEqual(self.storage.get_memory(3)['metadata'], {"a": 3})
+        self.assertEqual(self.storage.add_memory("I like tea"), 1)
+        self.assertEqual(self.storage.get_ids_by_content(["i like TEA "]), [1])
+        
+        # Reopening leaves the duplicates unhashed
+        self.storage.close()
+        self.storage = MemoryStorage(self.db_path)
+        self.assertEqual(len(self.storage.get_all_contents()), 3)
+        self.assertEqual(self.storage.add_memory("I like tea"), 1)
+    
     def test_add_memory_with_embedding(self):
         # Create a mock embedding
         embedding = np.array([0.1, 0.2, 0.3, 0.4, 0.5], dtype=np.float32)
@@ -50,9 +121,151 @@ class TestMemoryStorage(unittest.TestCase):
         self.assertIsNotNone(memory)
         self.assertEqual(memory['content'], "Test memory with embedding")
         
-        # Check that the embedding was stored correctly
+        # Check that the embedding was stored scaled to unit length
         self.assertIsNotNone(memory['embedding'])
-        np.testing.assert_array_equal(memory['embedding'], embedding)
+        np.testing.assert_allclose(memory['embedding'], embedding / np.linalg.norm(embedding), rtol=1e-6)
+    
+    def test_add_memory_with_float16_embedding(self):
+        # Use a new database that keeps embeddings as float16
+        self.storage.close()
+        os.unlink(self.db_path)
+        self.storage = MemoryStorage(self.db_path, embedding_dtype=np.float16)
+        embedding = np.array([0.1, 0.2, 0.3, 0.4, 0.5], dtype=np.float32)
+        memory_id = self.storage.add_memory("Test memory with embedding", embedding=embedding)
+        
+        # The embedding is stored at half precision
+        memory = self.storage.get_memory(memory_id)
+        self.assertEqual(memory['embedding'].dtype, np.float16)
+        np.testing.assert_allclose(memory['embedding'], embedding / np.linalg.norm(embedding), rtol=1e-3)
+        
+        # The dtype is recorded, so the database can't be misread as float32
+        self.storage.close()
+        with self.assertRaises(ValueError):
+            MemoryStorage(self.db_path, embedding_dtype=np.float32)
+        self.storage = MemoryStorage(self.db_path)
+        self.assertEqual(self.storage.embedding_dtype, np.float16)
+    
+    def test_embedding_dimension_mismatch(self):
+        memory_id = self.storage.add_memory("Three", embedding=np.array([1.0, 0.0, 0.0]))
+        self.assertEqual(self.storage.embedding_dim, 3)
+        
+        # Writes of another dimension are rejected and roll back
+        with self.assertRaises(ValueError):
+            self.storage.add_memory("Five", embedding=np.ones(5))
+        with self.assertRaises(ValueError):
+            self.storage.update_embeddings([(memory_id, np.ones(2))])
+        self.assertEqual(len(self.storage.get_all_contents()), 1)
+        
+        # A row of another size is reported rather than misread, and the
+        # unnormalized rows are left for the migration to rewrite once fixed
+        other_id = self.storage.add_memory("Other", embedding=np.array([0.0, 1.0, 0.0]))
+        self.storage.close()
+        bad_blob = np.array([2.0, 0.0], dtype=np.float32).tobytes()
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('UPDATE memories SET embedding = ? WHERE id = ?', (bad_blob, memory_id))
+            conn.execute(
+                'UPDATE memories SET embedding = ? WHERE id = ?',
+                (np.array([0.0, 2.0, 0.0], dtype=np.float32).tobytes(), other_id)
+            )
+        self.storage = MemoryStorage(self.db_path)
+        with self.assertRaisesRegex(ValueError, f"Memory {memory_id}"):
+            self.storage.get_embedding_matrix()
+        np.testing.assert_array_equal(self.storage.get_memory(other_id)['embedding'], [0.0, 2.0, 0.0])
+        self.assertEqual(self.storage.get_memory(memory_id)['embedding'].tobytes(), bad_blob)
+    
+    def test_add_memories(self):
+        # Add several memories in one transaction
+        embedding = np.array([0.1, 0.2, 0.3, 0.4, 0.5], dtype=np.float32)
+        memory_ids = self.storage.add_memories([
+            ("Memory 1", embedding, {"category": "test"}),
+            ("Memory 2", None, None)
+        ])
+        
+        # Check that the IDs match the inserted memories
+        self.assertEqual(len(memory_ids), 2)
+        memory = self.storage.get_memory(memory_ids[0])
+        self.assertEqual(memory['content'], "Memory 1")
+        np.testing.assert_allclose(memory['embedding'], embedding / np.linalg.norm(embedding), rtol=1e-6)
+        self.assertEqual(memory['metadata']['category'], "test")
+        memory = self.storage.get_memory(memory_ids[1])
+        self.assertEqual(memory['content'], "Memory 2")
+        self.assertIsNone(memory['embedding'])
+        
+        # Repeated content, in the batch or already stored, maps to one memory
+        more_ids = self.storage.add_memories([
+            ("Memory 3", None, None),
+            ("memory 1", None, None),
+            ("Memory 3", None, None)
+        ])
+        self.assertEqual(more_ids[1], memory_ids[0])
+        self.assertEqual(more_ids[0], more_ids[2])
+        self.assertEqual(len(self.storage.get_all_memories()), 3)
+    
+    def test_add_memories_array(self):
+        # Rows of one embedding matrix are stored as slices of a single buffer
+        storage = MemoryStorage(self.db_path, quantized_search=True)
+        embeddings = np.array([[3.0, 4.0, 0.0], [0.0, 0.0, 2.0]], dtype=np.float32)
+        memory_ids = storage.add_memories_array(["Memory 1", "Memory 2"], embeddings, [{"importance": 7}, None])
+        
+        memory = storage.get_memory(memory_ids[0])
+        np.testing.assert_allclose(memory['embedding'], [0.6, 0.8, 0.0], rtol=1e-3)
+        self.assertEqual(memory['metadata'], {"importance": 7})
+        np.testing.assert_allclose(storage.get_memory(memory_ids[1])['embedding'], [0.0, 0.0, 1.0])
+        
+        # The int8 copies are usable for search
+        similar_memories = storage.find_similar_memories(np.array([0.0, 0.1, 1.0]), limit=1)
+        self.assertEqual(similar_memories[0]['id'], memory_ids[1])
+        storage.close()
+    
+    def test_concurrent_writes(self):
+        # The shared connection serializes writes from several threads
+        threads = [
+            threading.Thread(target=self.storage.add_memory, args=(f"Memory {i}",))
+            for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(len(self.storage.get_all_memories()), 8)
+    
+    def test_get_memories_by_ids(self):
+        # Add some memories
+        memory_id1 = self.storage.add_memory("Memory 1")
+        memory_id2 = self.storage.add_memory("Memory 2")
+        memory_id3 = self.storage.add_memory("Memory 3")
+        
+        # Fetch a subset in a specific order, including a missing ID
+        memories = self.storage.get_memories_by_ids([memory_id3, 999, memory_id1])
+        self.assertEqual([m['id'] for m in memories], [memory_id3, memory_id1])
+        self.assertEqual(memories[0]['content'], "Memory 3")
+    
+    def test_token_count(self):
+        # Token counts are computed when content is written
+        memory_id = self.storage.add_memory(content="User lives in Berlin")
+        memory = self.storage.get_memory(memory_id)
+        self.assertEqual(memory['token_count'], count_tokens("User lives in Berlin"))
+        
+        self.storage.update_memory(memory_id, content="User lives in Munich, Germany")
+        memory = self.storage.get_memory(memory_id)
+        self.assertEqual(memory['token_count'], count_tokens("User lives in Munich, Germany"))
+    
+    def test_get_all_memories_without_metadata(self):
+        self.storage.add_memory("Memory 1", metadata={"importance": 5})
+        
+        # Metadata parsing can be skipped when it isn't needed
+        memories = self.storage.get_all_memories(include_metadata=False)
+        self.assertEqual(memories[0]['content'], "Memory 1")
+        self.assertIsNone(memories[0]['metadata'])
+        self.assertEqual(self.storage.get_all_memories()[0]['metadata'], {"importance": 5})
+    
+    def test_get_all_contents(self):
+        embedding = np.array([0.1, 0.2, 0.3], dtype=np.float32)
+        memory_id = self.storage.add_memory("Memory 1", embedding=embedding, metadata={"importance": 5})
+        
+        # Only IDs and contents are loaded
+        self.assertEqual(self.storage.get_all_contents(), [{'id': memory_id, 'content': "Memory 1"}])
     
     def test_delete_memory(self):
         # Add a memory
@@ -66,6 +279,14 @@ class TestMemoryStorage(unittest.TestCase):
         memory = self.storage.get_memory(memory_id)
         self.assertIsNone(memory)
     
+    def test_delete_memory_string_id(self):
+        # An ID given as a string leaves no row behind in the embedding copy
+        memory_id = self.storage.add_memory("Test memory", embedding=np.array([1.0, 0.0]))
+        self.storage.add_memory("Other memory", embedding=np.array([0.0, 1.0]))
+        self.storage.get_embedding_matrix()
+        self.assertTrue(self.storage.delete_memory(str(memory_id)))
+        self.assertNotIn(memory_id, self.storage.get_embedding_matrix()[1])
+    
     def test_find_similar_memories(self):
         # Create mock embeddings
         embedding1 = np.array([0.1, 0.2, 0.3, 0.4, 0.5], dtype=np.float32)
@@ -89,6 +310,109 @@ class TestMemoryStorage(unittest.TestCase):
         # Check that the memories are sorted by similarity (descending)
         self.assertGreater(similar_memories[0]['similarity'], similar_memories[1]['similarity'])
     
+    def test_find_similar_memories_after_changes(self):
+        memory_id1 = self.storage.add_memory("Memory 1", embedding=np.array([1.0, 0.0], dtype=np.float32))
+        memory_id2 = self.storage.add_memory("Memory 2", embedding=np.array([0.6, 0.8], dtype=np.float32))
+        query_embedding = np.array([2.0, 0.0], dtype=np.float32)
+        
+        similar_memories = self.storage.find_similar_memories(query_embedding, limit=5)
+        self.assertEqual([m['id'] for m in similar_memories], [memory_id1, memory_id2])
+        self.assertAlmostEqual(similar_memories[1]['similarity'], 0.6, places=5)
+        
+        # Writes are reflected in the next search
+        self.storage.delete_memory(memory_id1)
+        memory_id3 = self.storage.add_memory("Memory 3", embedding=np.array([0.8, 0.6], dtype=np.float32))
+        similar_memories = self.storage.find_similar_memories(query_embedding, limit=5)
+        self.assertEqual([m['id'] for m in similar_memories], [memory_id3, memory_id2])
+        
+        self.storage.update_memory(memory_id2, embedding=np.array([1.0, 0.0], dtype=np.float32))
+        similar_memories = self.storage.find_similar_memories(query_embedding, limit=5)
+        self.assertEqual([m['id'] for m in similar_memories], [memory_id2, memory_id3])
+    
+    def test_embedding_snapshot(self):
+        memory_id1 = self.storage.add_memory("Memory 1", embedding=np.array([1.0, 0.0], dtype=np.float32))
+        memory_id2 = self.storage.add_memory("Memory 2", embedding=np.array([0.6, 0.8], dtype=np.float32))
+        query_embedding = np.array([0.0, 1.0], dtype=np.float32)
+        self.storage.find_similar_memories(query_embedding)
+        self.storage.close()
+        
+        # The next session maps the saved copy instead of reading every embedding
+        self.storage = MemoryStorage(self.db_path)
+        similar_memories = self.storage.find_similar_memories(query_embedding)
+        self.assertEqual([m['id'] for m in similar_memories], [memory_id2, memory_id1])
+        self.assertIsInstance(self.storage._emb_matrix, np.memmap)
+        self.storage.close()
+        
+        # A session that writes without searching makes the snapshot stale
+        storage = MemoryStorage(self.db_path)
+        storage.update_memory(memory_id1, embedding=np.array([0.0, 1.0], dtype=np.float32))
+        storage.update_memory(memory_id2, embedding=np.array([1.0, 0.0], dtype=np.float32))
+        storage.close()
+        self.storage = MemoryStorage(self.db_path)
+        similar_memories = self.storage.find_similar_memories(query_embedding)
+        self.assertEqual([m['id'] for m in similar_memories], [memory_id1, memory_id2])
+        self.assertAlmostEqual(similar_memories[0]['similarity'], 1.0, places=5)
+        
+        # Writes through another connection are picked up by the next search
+        storage = MemoryStorage(self.db_path)
+        storage.delete_memory(memory_id1)
+        storage.close()
+        similar_memories = self.storage.find_similar_memories(query_embedding)
+        self.assertEqual([m['id'] for m in similar_memories], [memory_id2])
+    
+    @unittest.skipIf(sqlite_vec is None, "sqlite-vec is not installed")
+    def test_vec_table_rebuilt_after_writes_without_sqlite_vec(self):
+        memory_id = self.storage.add_memory("Test memory", embedding=np.array([1.0, 0.0]))
+        self.storage.close()
+        
+        # A process without sqlite-vec can't keep the mirror in step
+        with patch('src.storage.sqlite_vec', None):
+            other = MemoryStorage(self.db_path)
+            other.delete_memory(memory_id)
+            other.add_memory("New memory", embedding=np.array([0.0, 1.0]))
+            other.close()
+        
+        # so the next open with it rebuilds the mirror
+        self.storage = MemoryStorage(self.db_path)
+        results = self.storage.find_similar_memories(np.array([1.0, 0.0]), limit=5)
+        self.assertEqual([m['content'] for m in results], ["New memory"])
+    
+    def test_find_similar_memories_quantized(self):
+        storage = MemoryStorage(self.db_path, quantized_search=True)
+        memory_id1 = storage.add_memory("Memory 1", embedding=np.array([1.0, 0.0, 0.0], dtype=np.float32))
+        memory_id2 = storage.add_memory("Memory 2", embedding=np.array([0.6, 0.8, 0.0], dtype=np.float32))
+        storage.add_memory("Memory 3", embedding=np.array([0.0, 0.0, 1.0], dtype=np.float32))
+        
+        # int8 scores approximate the float32 cosine similarities
+        query_embedding = np.array([0.9, 0.1, 0.0])
+        similar_memories = storage.find_similar_memories(query_embedding, limit=2)
+        self.assertEqual([m['id'] for m in similar_memories], [memory_id1, memory_id2])
+        expected = np.dot(query_embedding / np.linalg.norm(query_embedding), [0.6, 0.8, 0.0])
+        self.assertAlmostEqual(similar_memories[1]['similarity'], expected, places=2)
+        
+        # The int8 scan is used even when a sqlite-vec table exists
+        storage._vec_dim = 3
+        self.assertEqual(storage.find_similar_memories(query_embedding, limit=1)[0]['id'], memory_id1)
+        storage._vec_dim = None
+        storage.close()
+    
+    def test_find_similar_memories_lsh_prefilter(self):
+        storage = MemoryStorage(self.db_path, lsh_prefilter=True)
+        embeddings = np.random.default_rng(0).standard_normal((100, 16)).astype(np.float32)
+        memory_ids = storage.add_memories_array([f"Memory {i}" for i in range(100)], embeddings)
+        
+        # Only 10 candidates per result are scored exactly, but an exact match
+        # has an identical signature and is always among them
+        similar_memories = storage.find_similar_memories(embeddings[42], limit=1)
+        self.assertEqual(similar_memories[0]['id'], memory_ids[42])
+        self.assertAlmostEqual(similar_memories[0]['similarity'], 1.0, places=5)
+        
+        # Signatures follow writes
+        storage.delete_memory(memory_ids[42])
+        new_id = storage.add_memory("New memory", embedding=embeddings[42])
+        self.assertEqual(storage.find_similar_memories(embeddings[42], limit=1)[0]['id'], new_id)
+        storage.close()
+    
     def test_search_by_content(self):
         # Add some memories
         self.storage.add_memory("I like apples")
@@ -107,6 +431,21 @@ class TestMemoryStorage(unittest.TestCase):
         # Check that we got 1 memory
         self.assertEqual(len(memories), 1)
         self.assertEqual(memories[0]['content'], "I like apples")
+        
+        # Words match across inflections
+        self.assertEqual(len(self.storage.search_by_content("liked")), 3)
+    
+    def test_search_by_content_after_changes(self):
+        memory_id = self.storage.add_memory("I like apples")
+        self.storage.add_memory("I like bananas")
+        
+        # The full-text index follows updates and deletes
+        self.storage.update_memory(memory_id, content="I like pears")
+        self.assertEqual(self.storage.search_by_content("apples"), [])
+        self.assertEqual(self.storage.search_by_content("pear")[0]['id'], memory_id)
+        
+        self.storage.delete_memory(memory_id)
+        self.assertEqual(len(self.storage.search_by_content("like")), 1)
     
     def test_update_memory(self):
         # Add a memory
@@ -127,8 +466,14 @@ class TestMemoryStorage(unittest.TestCase):
         # Retrieve the updated memory
         memory = self.storage.get_memory(memory_id)
         self.assertEqual(memory['content'], "Updated content")
-        np.testing.assert_array_equal(memory['embedding'], new_embedding)
+        np.testing.assert_allclose(memory['embedding'], new_embedding / np.linalg.norm(new_embedding), rtol=1e-6)
         self.assertEqual(memory['metadata']['category'], "updated")
+        
+        # Missing memories are reported whether or not there is anything to update
+        self.assertTrue(self.storage.update_memory(memory_id))
+        self.assertFalse(self.storage.update_memory(memory_id + 1))
+        self.assertFalse(self.storage.update_memory(memory_id + 1, embedding=new_embedding))
+        self.assertEqual(self.storage.find_similar_memories(new_embedding)[0]['id'], memory_id)
     
     def test_get_all_memories(self):
         # Add some memories